@@ -5,28 +5,57 @@
 
 import threading
 import random
-import json
 import logging
 import signal
 import os
 import sys
+import atexit
 from pathlib import Path
 import glob
+import hmac
+import secrets
 import time
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any
 
 import requests.exceptions
+from requests.adapters import HTTPAdapter
 from urllib3.exceptions import NewConnectionError
 
 import telebot
 from telebot import types
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
-from json.decoder import JSONDecodeError
+from telebot.util import antiflood
+import orjson
+from orjson import JSONDecodeError
+import fastjsonschema
 
 # Constants
 QUESTIONS_DIR = Path('questions')
 SESSIONS_DIR = Path('data/user_sessions')
+JOURNAL_FILE = Path('data/journal.log')
+FILE_ID_CACHE_FILE = Path('data/file_id_cache.json')
+JOURNAL_MAX_SIZE = 1024 * 1024 # compact journal into session files above this size
+SESSION_FLUSH_INTERVAL = 5.0 # seconds between background session saves, answers in between are kept by the journal
+MAX_CACHED_SESSIONS = 2048 # least recently used sessions above this are dropped from memory
+SESSION_EVICT_IDLE = 60 # seconds a session must be unused before eviction, handlers may still hold it before that
+SEND_WORKERS = 8 # threads sending messages to Telegram
+MAX_PENDING_SENDS = 256 # handlers block when this many sends are queued
+SEND_RATE_LIMIT = 30 # messages per second, Telegram global limit for bots
+RESTART_DEBOUNCE = 1.0 # seconds without bot.py changes before restarting
+LONG_POLLING_TIMEOUT = 30 # seconds Telegram holds getUpdates open
+POLLING_TIMEOUT = 35 # request timeout, must exceed LONG_POLLING_TIMEOUT
+ALLOWED_UPDATES = ["message", "callback_query"] # Only update types the bot has handlers for
+WEBHOOK_URL = os.getenv('WEBHOOK_URL') # Public https url of the bot, long polling is used when not set
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080')) # Local http port behind the TLS-terminating proxy
+# Checked against X-Telegram-Bot-Api-Secret-Token header, a random one is passed to set_webhook if not set
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+MAX_CAPTION_LENGTH = 1024 # Telegram limit for media captions
+MAX_MESSAGE_LENGTH = 4096 # Telegram limit for message text
+JSON_DUMP_OPTIONS = orjson.OPT_NON_STR_KEYS # compact output, int question ids are written as string keys
+AUDIO_EXTS = frozenset({'.mp3', '.ogg', '.wav'})
+IMAGE_EXTS = frozenset({'.jpg', '.png', '.jpeg', '.webp', '.gif', '.bmp'})
 
 logging.basicConfig(
     level=logging.INFO,
@@ -42,32 +71,114 @@ if not bot_token:
 logger.info(f"Bot init, token: {bot_token}")
 bot = telebot.TeleBot(bot_token)
 
+# One keep-alive connection pool for polling and all send workers instead of a session per thread.
+# pool_connections is the number of per-host pools, every request goes to api.telegram.org
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=SEND_WORKERS * 2, max_retries=0))
+telebot.apihelper.session = http_session
 
-sessions = {} # Global dictionary to store sessions
+class OrjsonCompat:
+    """json module stand-in for telebot, dumps returns str like json.dumps"""
+    loads = staticmethod(orjson.loads)
+
+    @staticmethod
+    def dumps(obj, **_kwargs) -> str:
+        return orjson.dumps(obj).decode()
+
+def parse_response_with_orjson(response, *_args, **_kwargs):
+    """Session hook: telebot reads API results with response.json()"""
+    response.json = lambda **_kwargs: orjson.loads(response.content)
+    return response
+
+# Markups, entities and webhook updates go through telebot's module-level json, API results through requests
+telebot.apihelper.json = telebot.types.json = OrjsonCompat
+http_session.hooks['response'].append(parse_response_with_orjson)
+
+
+sessions = OrderedDict() # Global LRU of sessions, most recently used last
 sessions_lock = threading.RLock() # Global lock for sessions
-file_id_cache = {} # tg file_id cache
+file_id_cache = {} # tg file_id cache, "path:mtime_ns:size" -> file_id, persisted to FILE_ID_CACHE_FILE
+file_id_cache_dirty = threading.Event()
+upload_locks = {} # cache key -> lock held while the file is uploaded, so concurrent sends wait for its file_id
+upload_locks_lock = threading.Lock()
+dirty_sessions = set() # Sessions waiting to be saved by the flusher thread
+dirty_sessions_lock = threading.Lock()
+
+# Static keyboards, built once and reused (telebot serializes them at send time)
+POST_ANSWER_KEYBOARD = types.InlineKeyboardMarkup(row_width=3)
+POST_ANSWER_KEYBOARD.add(
+    types.InlineKeyboardButton(text="Дальше ➡️", callback_data="next"),
+    types.InlineKeyboardButton(text="📊", callback_data="stats"),
+    types.InlineKeyboardButton(text="Тема 🔄", callback_data="change_theme"),
+)
+STATS_KEYBOARD = types.InlineKeyboardMarkup()
+STATS_KEYBOARD.add(
+    types.InlineKeyboardButton(text="Вопрос ➡️", callback_data="next"),
+    types.InlineKeyboardButton(text="Общий рейтинг 🏆", callback_data="global_stats"),
+)
+GLOBAL_STATS_KEYBOARD = types.InlineKeyboardMarkup()
+GLOBAL_STATS_KEYBOARD.add(types.InlineKeyboardButton(text="Вернуться к вопросам ➡️", callback_data="next"))
+VOICE_FORBIDDEN_KEYBOARD = types.InlineKeyboardMarkup()
+VOICE_FORBIDDEN_KEYBOARD.add(types.InlineKeyboardButton(text="Я разрешил ✅", callback_data="next"))
+
+POSITION_EMOJIS = ("", "🥇", "🥈", "🥉")
+NUMBER_EMOJIS = ("1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣", "🔟")
 
 def get_position_emoji(position: int) -> str:
-    emojis = ["", "🥇", "🥈", "🥉"]
-    return emojis[position] if 1 <= position <= 3 else ""
+    return POSITION_EMOJIS[position] if 1 <= position <= 3 else ""
 
 def get_number_emoji(number: int) -> str:
-    emojis = ["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣", "🔟"]
-    return emojis[number - 1] if 1 <= number <= 10 else str(number)
+    return NUMBER_EMOJIS[number - 1] if 1 <= number <= 10 else str(number)
 
 
+def render_options(options) -> List[str]:
+    """Options lines prefixed with number emojis"""
+    return [f"{get_number_emoji(i)} {option}" for i, option in enumerate(options, 1)]
+
+answer_keyboard_templates = {} # options count -> answer keyboard JSON with QUESTION_ID placeholder
+
+def get_answer_keyboard_json(question_id: int, num_options: int) -> str:
+    """Answer buttons keyboard as ready JSON, telebot sends str reply_markup as is"""
+    template = answer_keyboard_templates.get(num_options)
+    if template is None:
+        buttons = [
+            { 'text': get_number_emoji(idx), 'callback_data': f"answer:QUESTION_ID:{idx}" }
+            for idx in range(1, num_options + 1)
+        ]
+        template = orjson.dumps({ 'inline_keyboard': [buttons] }).decode()
+        answer_keyboard_templates[num_options] = template
+    return template.replace('QUESTION_ID', str(question_id))
+
+def get_marked_answer_keyboard_json(question_id: int, button_texts: List[str]) -> str:
+    """Answer buttons keyboard with custom button texts (answer marks) as ready JSON"""
+    buttons = [
+        { 'text': text, 'callback_data': f"answer:{question_id}:{idx}" }
+        for idx, text in enumerate(button_texts, 1)
+    ]
+    return orjson.dumps({ 'inline_keyboard': [buttons] }).decode()
+
 def get_user_info(user) -> str:
     """Helper function to get user info for logs"""
     if user.username:
         return f"@{user.username} ({user.id})"
     return f"{user.first_name} ({user.id})"
 
+_rng = threading.local()
+
+def rng():
+    """Per-thread Random, handlers don't share the module-level generator"""
+    r = getattr(_rng, 'r', None)
+    if r is None:
+        r = _rng.r = random.Random()
+    return r
+
 class UserSession:
     def __init__(self, user):
         self.user_info = get_user_info(user)
         self.user_id = user.id
         self.user_name = user.username or user.first_name
         self.lock = threading.RLock()
+        self.last_used = time.monotonic() # Read by evict_idle_session
         self.sessions_dir = SESSIONS_DIR
 
         # Create all necessary directories
@@ -81,8 +192,11 @@ class UserSession:
         if self.session_file.exists():
             logger.info(f"Loading existing session for user {self.user_info}")
             try:
-                with open(self.session_file, 'r', encoding='utf-8') as f:
-                    self.data = json.load(f)
+                with open(self.session_file, 'rb') as f:
+                    self.data = orjson.loads(f.read())
+                # JSON object keys are always strings, keep question ids as ints in memory
+                for theme_stats in self.data.get('theme_stats', {}).values():
+                    theme_stats['question_stats'] = { int(q_id): q_stats for q_id, q_stats in theme_stats.get('question_stats', {}).items() }
                 logger.info(f"Loaded session data for user {self.user_info}")
             except Exception as e:
                 logger.error(f"Failed to load session for user {self.user_info}: {e}")
@@ -93,43 +207,58 @@ class UserSession:
 
         # Always update user info in data
         self.data.update({ 'user_id': self.user_id, 'user_name': self.user_name, 'last_update': time.time() })
-        self.save_session()  # Save immediately to ensure user data is stored
+        self.mark_dirty()  # Saved by the flusher thread, no blocking write while handling the update
 
-        try:
-            self.question_selector = QuestionSelector()
-            logger.info(f"QuestionSelector initialized for user {self.user_info}")
-        except Exception as e:
-            logger.error(f"Failed to initialize QuestionSelector for user {self.user_info}: {e}")
-            raise
+        self.question_selector = QUESTION_SELECTOR
 
     def save_session(self):
         """Save session data to file"""
-        try:
-            # Ensure directory exists
-            self.session_file.parent.mkdir(parents=True, exist_ok=True)
-            
-            with open(self.session_file, 'w', encoding='utf-8') as f:
-                json.dump(self.data, f, ensure_ascii=False, indent=2)
-            logger.info(f"Saved session data for user {self.user_info}")
-        except Exception as e:
-            logger.error(f"Failed to save session for user {self.user_info}: {e}")
+        with self.lock:
+            try:
+                # Encode before touching the disk, then one write to a temp file and a rename:
+                # a crash mid-write cannot truncate the session. Sessions dir is created in __init__
+                data = orjson.dumps(self.data, option=JSON_DUMP_OPTIONS)
+                tmp_file = self.session_file.with_suffix('.tmp')
+                with open(tmp_file, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_file, self.session_file)
+                logger.info(f"Saved session data for user {self.user_info}")
+            except Exception as e:
+                logger.error(f"Failed to save session for user {self.user_info}: {e}")
+
+    def mark_dirty(self):
+        """Queue session to be saved by the flusher thread"""
+        with dirty_sessions_lock:
+            dirty_sessions.add(self)
 
     def set_last_question(self, question: Dict[str, Any]):
         with self.lock:
             self.data['last_question'] = question
             logger.info(f"Set last question for user {self.user_info}: Question ID {question['question_id']}")
-            self.save_session()
+            self.mark_dirty()
 
     def get_last_question(self) -> Dict[str, Any]:
         with self.lock:
             return self.data.get('last_question')
 
-    def clear_last_question(self):
+    def clear_last_question(self, question_id: int = None):
+        """Clear last question, if question_id is given only when it is still that question"""
         with self.lock:
-            if 'last_question' in self.data:
+            last_question = self.data.get('last_question')
+            if last_question and (question_id is None or last_question['question_id'] == question_id):
                 del self.data['last_question']
                 logger.info(f"Cleared last_question for user {self.user_info}")
-                self.save_session()
+                self.mark_dirty()
+
+    def pop_last_question(self, question_id: int) -> Dict[str, Any]:
+        """Take last question if it is still question_id, so only one answer per question is counted"""
+        with self.lock:
+            last_question = self.data.get('last_question')
+            if not last_question or last_question.get('question_id') != question_id:
+                return None
+            del self.data['last_question']
+            self.mark_dirty()
+            return last_question
 
     def reset_session(self):
         with self.lock:            
@@ -145,6 +274,7 @@ class UserSession:
         self.data = {}
         logger.info(f"Session reset for user {self.user_info}")
         self.save_session()
+        journal_append({ 'user_id': self.user_id, 'reset': True, 'ts': time.time() })
 
     def update_question_stats(self, question_id: int, is_correct: bool, theme: str):
         """Update statistics for the given question"""
@@ -159,7 +289,7 @@ class UserSession:
             theme_stats = self.data['theme_stats'][theme]
             
             # Update question-specific stats
-            q_id = str(question_id)
+            q_id = question_id
             if q_id not in theme_stats['question_stats']:
                 theme_stats['question_stats'][q_id] = {'total': 0, 'correct': 0}
             
@@ -175,7 +305,12 @@ class UserSession:
                 f"total={theme_stats['question_stats'][q_id]['total']}, "
                 f"correct={theme_stats['question_stats'][q_id]['correct']}"
             )
-            self.save_session()
+            self.mark_dirty()
+            # Theme total after this answer, lets replay skip events already saved to the session file
+            event = { 'user_id': self.user_id, 'theme': theme, 'question_id': question_id,
+                      'correct': is_correct, 'total': theme_stats['total'], 'ts': time.time() }
+
+        journal_append(event)
 
     def get_statistics(self):
         """Get detailed statistics for all themes"""
@@ -194,8 +329,7 @@ class UserSession:
                     # Get per-question stats for this theme
                     question_stats = []
                     for q in theme_data['questions']:
-                        q_id = str(q['id'])
-                        q_stats = stats['question_stats'].get(q_id, {'total': 0, 'correct': 0})
+                        q_stats = stats['question_stats'].get(q['id'], {'total': 0, 'correct': 0})
                         
                         if q_stats['total'] > 0:
                             percentage = (q_stats['correct'] / q_stats['total']) * 100
@@ -224,7 +358,7 @@ class UserSession:
         with self.lock:
             self.data['current_theme'] = theme
             logger.info(f"Set theme for user {self.user_info}: {theme}")
-            self.save_session()
+            self.mark_dirty()
 
     def get_theme(self) -> str:
         """Get current theme from user data"""
@@ -252,20 +386,21 @@ class UserSession:
             theme_stats = self.data.get('theme_stats', {}).get(current_theme, {})
             question_stats = theme_stats.get('question_stats', {})
 
-            # Group questions by number of correct answers
-            questions_by_correct = {}
+            # Collect questions with minimum correct answers in one pass, without grouping all of them
+            min_correct = None
+            candidate_questions = []
             for q in questions:
-                correct = question_stats.get(str(q['id']), {}).get('correct', 0)
-                if correct not in questions_by_correct:
-                    questions_by_correct[correct] = []
-                questions_by_correct[correct].append(q)
-
-            # Get questions with minimum correct answers
-            min_correct = min(questions_by_correct.keys()) if questions_by_correct else 0
-            candidate_questions = questions_by_correct.get(min_correct, questions)
-            
+                q_stats = question_stats.get(q['id'])
+                correct = q_stats['correct'] if q_stats else 0
+                if min_correct is None or correct < min_correct:
+                    min_correct = correct
+                    candidate_questions = [q]
+                elif correct == min_correct:
+                    candidate_questions.append(q)
+
             # Randomly select from the questions with minimum correct answers
-            question = random.choice(candidate_questions)
+            r = rng()
+            question = r.choice(candidate_questions)
             correct_answer = question['correct_answer']
 
             # Handle 'wrong_answers' if present in the question
@@ -273,32 +408,28 @@ class UserSession:
                 wrong_answers = question['wrong_answers']
                 if len(wrong_answers) >= num_options - 1:
                     # Use provided wrong_answers, selecting only (num_options-1) if more are provided
-                    selected_wrong = random.sample(wrong_answers, num_options - 1)
+                    selected_wrong = r.sample(wrong_answers, num_options - 1)
                 else:
                     # Use provided wrong_answers and supplement with random ones
-                    # Filter out answers that match the correct answer
-                    other_answers = [q['correct_answer'] for q in questions 
-                                    if q['id'] != question['id'] and 
-                                    q['correct_answer'] != correct_answer]
+                    other_answers = theme_data['other_answers'][question['id']]
                     needed = (num_options - 1) - len(wrong_answers)
-                    random_wrong = random.sample(other_answers, needed) if needed > 0 else []
+                    random_wrong = r.sample(other_answers, needed) if needed > 0 else []
                     selected_wrong = wrong_answers + random_wrong
-                options = selected_wrong + [correct_answer]
+                    r.shuffle(selected_wrong)
             else:
-                # Filter out answers that match the correct answer
-                other_answers = [q['correct_answer'] for q in questions 
-                                if q['id'] != question['id'] and 
-                                q['correct_answer'] != correct_answer]
-                wrong_answers = random.sample(other_answers, min(len(other_answers), num_options - 1))
-                options = wrong_answers + [correct_answer]
+                other_answers = theme_data['other_answers'][question['id']]
+                selected_wrong = r.sample(other_answers, min(len(other_answers), num_options - 1))
             
-            random.shuffle(options)
-            correct_option = options.index(correct_answer) + 1  # 1-based indexing
+            # Put correct answer into a random slot, wrong answers (already in random order) fill the rest
+            options = list(selected_wrong)
+            correct_idx = r.randrange(len(options) + 1)
+            options.insert(correct_idx, correct_answer)
+            correct_option = correct_idx + 1  # 1-based indexing
 
             # Handle files if present
             file = None
             if question.get('files'):
-                file = random.choice(question['files'])
+                file = r.choice(question['files'])
                 logger.info(f"Selected file {file} for question {question['id']}")
 
             return {
@@ -311,108 +442,138 @@ class UserSession:
                 'theme_name': theme_data['name']
             }
 
+THEME_SCHEMA = {
+    'type': 'object',
+    'required': ['tag', 'name', 'questions'],
+    'properties': {
+        'questions': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'required': ['id', 'text', 'correct_answer'],
+                'properties': {
+                    'id': {'type': 'integer'},
+                    'text': {'type': 'string'},
+                    'correct_answer': {'type': 'string'},
+                    'files': {'type': 'array', 'items': {'type': 'string'}},
+                    'explanation': {'type': 'array', 'items': {'type': 'string'}},
+                },
+            },
+        },
+    },
+}
+
+# Compiled validator raises JsonSchemaException (a ValueError subclass)
+compiled_theme_validator = fastjsonschema.compile(THEME_SCHEMA)
+
 def validate_theme_data(theme_data):
     """Validate theme data structure"""
-    # Check required top-level fields
-    required_fields = ['tag', 'name', 'questions']
-    for field in required_fields:
-        if field not in theme_data:
-            raise ValueError(f"Missing required field '{field}' in theme data")
-            
-    # Validate questions array
-    if not isinstance(theme_data['questions'], list):
-        raise ValueError("'questions' must be an array")
-        
-    # Validate each question
-    for question in theme_data['questions']:
-        # Check required question fields
-        required_question_fields = ['id', 'text', 'correct_answer']
-        for field in required_question_fields:
-            if field not in question:
-                raise ValueError(f"Question missing required field '{field}'")
-                
-        # Validate ID is integer
-        if not isinstance(question['id'], int):
-            raise ValueError(f"Question ID must be an integer, got {type(question['id'])}")
-            
-        # Validate text and correct_answer are strings
-        if not isinstance(question['text'], str):
-            raise ValueError(f"Question text must be a string, got {type(question['text'])}")
-        if not isinstance(question['correct_answer'], str):
-            raise ValueError(f"Question correct_answer must be a string, got {type(question['correct_answer'])}")
-            
-        # Validate files if present
-        if 'files' in question:
-            if not isinstance(question['files'], list):
-                raise ValueError("files must be an array")
-            for path in question['files']:
-                if not isinstance(path, str):
-                    raise ValueError(f"Audio path must be a string, got {type(path)}")
-                    
-        # Validate explanation if present
-        if 'explanation' in question:
-            if not isinstance(question['explanation'], list):
-                raise ValueError("explanation must be an array")
-            for exp in question['explanation']:
-                if not isinstance(exp, str):
-                    raise ValueError(f"Explanation must be a string, got {type(exp)}")
+    compiled_theme_validator(theme_data)
 
 class QuestionSelector:
     def __init__(self):
         self.themes = {}
-        self.current_theme = None
+        self.theme_files = {} # theme file path -> theme tag
+        self.lock = threading.Lock()
         folder = "questions"
         logger.info(f"Loading questions from {os.path.abspath(folder)}")
         theme_files = glob.glob(os.path.join(folder, '*.json'))
         logger.info(f"Found {len(theme_files)} theme files")
         
-        for file_path in theme_files:
+        # Load files in parallel, then merge in glob order
+        with ThreadPoolExecutor(max_workers=max(1, min(8, len(theme_files)))) as executor:
+            futures = [executor.submit(self._load_theme_file, file_path) for file_path in theme_files]
+
+        for file_path, future in zip(theme_files, futures):
             try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    theme_data = json.load(f)
-                    
-                    # Validate theme data structure
-                    validate_theme_data(theme_data)
-                    
-                    theme_tag = theme_data.get('tag')
-                    if not theme_tag:
-                        logger.warning(f"No tag found in {file_path}, using filename")
-                        theme_tag = Path(file_path).stem
-                    
-                    # Check questions files before adding theme
-                    logger.info(f"Checking theme '{theme_tag}' for missing files")
-                    missing_files = self._check_questions_files(theme_data.get('questions', []))
-                    if missing_files:
-                        files_str = "\n".join(f"- {f}" for f in missing_files)
-                        logger.error(f"Missing questions files for theme '{theme_tag}':\n{files_str}")
-                        raise ValueError(f"Missing questions files for theme '{theme_tag}':\n{files_str}")
-
-                    # Check for duplicate correct_answer in questions
-                    self._check_duplicate_correct_answers(theme_data['questions'], theme_tag)
-
-                    # Check for duplicate question IDs within this theme
-                    questions = theme_data.get('questions', [])
-                    seen_question_ids = set()
-                    for question in questions:
-                        question_id = question.get('id')
-                        if not question_id:
-                            logger.error(f"Question ID missing in theme '{theme_tag}'")
-                            raise ValueError(f"Question ID missing in theme '{theme_tag}'")
-                        
-                        if question_id in seen_question_ids:
-                            logger.error(f"Duplicate question ID {question_id} found within theme '{theme_tag}'")
-                            raise ValueError(f"Duplicate question ID {question_id} found within theme '{theme_tag}'")
-                        seen_question_ids.add(question_id)
-                        
-                    self.themes[theme_tag] = {
-                        'name': theme_data.get('name', theme_tag),
-                        'questions': questions
-                    }
-                logger.info(f"Loaded {len(self.themes[theme_tag]['questions'])} questions for theme '{theme_tag}' ({self.themes[theme_tag]['name']})")
+                theme_tag, theme = future.result()
+                self.themes[theme_tag] = theme
+                self.theme_files[str(Path(file_path))] = theme_tag
+                logger.info(f"Loaded {len(theme['questions'])} questions for theme '{theme_tag}' ({theme['name']})")
             except Exception as e:
                 logger.error(f"Failed to load questions from {file_path}: {e}")
                 raise
 
+    def _load_theme_file(self, file_path):
+        """Load and validate one theme file, returns (theme_tag, theme)"""
+        with open(file_path, 'rb') as f:
+            theme_data = orjson.loads(f.read())
+            
+        # Validate theme data structure
+        validate_theme_data(theme_data)
+        
+        theme_tag = theme_data.get('tag')
+        if not theme_tag:
+            logger.warning(f"No tag found in {file_path}, using filename")
+            theme_tag = Path(file_path).stem
+        
+        # Check questions files before adding theme
+        logger.info(f"Checking theme '{theme_tag}' for missing files")
+        missing_files = self._check_questions_files(theme_data.get('questions', []))
+        if missing_files:
+            files_str = "\n".join(f"- {f}" for f in missing_files)
+            logger.error(f"Missing questions files for theme '{theme_tag}':\n{files_str}")
+            raise ValueError(f"Missing questions files for theme '{theme_tag}':\n{files_str}")
+
+        self._prefer_opus_files(theme_data.get('questions', []), theme_tag)
+
+        # Check for duplicate correct_answer in questions
+        self._check_duplicate_correct_answers(theme_data['questions'], theme_tag)
+
+        # Check for duplicate question IDs within this theme
+        questions = theme_data.get('questions', [])
+        seen_question_ids = set()
+        for question in questions:
+            question_id = question.get('id')
+            if not question_id:
+                logger.error(f"Question ID missing in theme '{theme_tag}'")
+                raise ValueError(f"Question ID missing in theme '{theme_tag}'")
+            
+            if question_id in seen_question_ids:
+                logger.error(f"Duplicate question ID {question_id} found within theme '{theme_tag}'")
+                raise ValueError(f"Duplicate question ID {question_id} found within theme '{theme_tag}'")
+            seen_question_ids.add(question_id)
+            
+        # Lookup indices, first question wins for duplicate answers
+        questions_by_answer = {}
+        for question in questions:
+            questions_by_answer.setdefault(question['correct_answer'], question)
+        # Wrong answer candidates per question: answers of the other questions of the theme
+        answers = [question['correct_answer'] for question in questions]
+        other_answers = {
+            question['id']: tuple(answer for answer in answers if answer != question['correct_answer'])
+            for question in questions
+        }
+
+        return theme_tag, {
+            'name': theme_data.get('name', theme_tag),
+            'questions': questions,
+            'questions_by_id': {question['id']: question for question in questions},
+            'questions_by_answer': questions_by_answer,
+            'other_answers': other_answers
+        }
+
+    def reload_theme_file(self, file_path):
+        """Reload one changed theme file, keeping the old theme if the new file is broken"""
+        file_path = str(Path(file_path))
+        try:
+            theme_tag, theme = self._load_theme_file(file_path)
+        except Exception as e:
+            logger.error(f"Failed to reload questions from {file_path}, keeping previous version: {e}")
+            return False
+
+        with self.lock:
+            # Swap the whole dict so readers iterating over themes never see it change
+            themes = dict(self.themes)
+            old_tag = self.theme_files.get(file_path)
+            if old_tag and old_tag != theme_tag:
+                themes.pop(old_tag, None)
+            themes[theme_tag] = theme
+            self.theme_files[file_path] = theme_tag
+            self.themes = themes
+        logger.info(f"Reloaded {len(theme['questions'])} questions for theme '{theme_tag}' ({theme['name']})")
+        return True
+
     def _check_questions_files(self, questions) -> list:
         """Check if all required questions files exist"""
         missing_files = []
@@ -426,6 +587,22 @@ class QuestionSelector:
                         missing_files.append(str(full_path))
         return missing_files
 
+    def _prefer_opus_files(self, questions, theme_tag):
+        """Use .ogg (Opus) next to .mp3/.wav audio if it exists: it's smaller and Telegram takes it as voice as is"""
+        not_converted = []
+        for question in questions:
+            files = question.get('files', [])
+            for i, file_path in enumerate(files):
+                base, ext = os.path.splitext(file_path)
+                if ext.lower() not in AUDIO_EXTS or ext.lower() == '.ogg':
+                    continue
+                if (Path('questions') / f"{base}.ogg").exists():
+                    files[i] = f"{base}.ogg"
+                else:
+                    not_converted.append(file_path)
+        if not_converted:
+            logger.warning(f"Audio files in theme '{theme_tag}' are not converted to ogg, run convert_mp3.sh: {not_converted}")
+
     def _check_duplicate_correct_answers(self, questions, theme_tag):
         """Check for duplicate correct_answer in questions"""
         correct_answers = set()
@@ -435,18 +612,12 @@ class QuestionSelector:
                 logger.error(f"Duplicate correct_answer '{answer}' found in theme '{theme_tag}'")
             correct_answers.add(answer)
 
-    def set_theme(self, theme_tag: str) -> bool:
+    def has_theme(self, theme_tag: str) -> bool:
         if theme_tag in self.themes:
-            self.current_theme = theme_tag
             return True
         logger.warning(f"Theme '{theme_tag}' not found")
         return False
 
-    def get_current_theme(self) -> Dict[str, str]:
-        if self.current_theme:
-            return { 'tag': self.current_theme, 'name': self.themes[self.current_theme]['name'] }
-        return None
-
     def get_themes(self) -> List[Dict[str, str]]:
         """Returns a list of dictionaries containing theme information"""
         return [
@@ -461,28 +632,213 @@ class QuestionSelector:
             for tag, data in self.themes.items()
         }
 
+QUESTION_SELECTOR = QuestionSelector() # Shared by all user sessions
+
 def get_session(user) -> UserSession:
+    if user is None:
+        logger.error("User object is None")
+        raise ValueError("User object cannot be None")
+
+    # Fast path: dict.get is atomic, so cached sessions are returned without waiting for the lock
+    session = sessions.get(user.id)
+    if session is not None:
+        session.last_used = time.monotonic()
+        # Formatted user info is cached on the session, refresh it only if the name changed
+        user_name = user.username or user.first_name
+        if user_name != session.user_name:
+            session.user_name = user_name
+            session.user_info = get_user_info(user)
+        # Refresh LRU position only if nobody holds the lock, approximate recency is fine
+        if sessions_lock.acquire(blocking=False):
+            try:
+                if user.id in sessions:
+                    sessions.move_to_end(user.id)
+            finally:
+                sessions_lock.release()
+        return session
+
     with sessions_lock:
-        if user is None:
-            logger.error("User object is None")
-            raise ValueError("User object cannot be None")
-        
+        # Double-check: another thread could create the session while we waited
         if user.id not in sessions:
             logger.info(f"Creating/loading session for user {get_user_info(user)}")
             session = UserSession(user)
             
-            # Restore theme from user profile if exists
+            # Drop saved theme if it no longer exists
             saved_theme = session.get_theme()
-            if saved_theme:
-                session.question_selector.set_theme(saved_theme)
-                logger.info(f"Restored theme {saved_theme} for user {get_user_info(user)}")
+            if saved_theme and not session.question_selector.has_theme(saved_theme):
+                session.set_theme(None)
+                logger.info(f"Dropped unknown theme {saved_theme} for user {session.user_info}")
             
             sessions[user.id] = session
+            if len(sessions) > MAX_CACHED_SESSIONS:
+                evict_idle_session()
         return sessions[user.id]
 
+def evict_idle_session():
+    """Drop the least recently used session nobody may still be changing, called with sessions_lock held.
+    A session returned by the lock-free fast path moments ago or waiting for the flusher stays cached,
+    otherwise a second UserSession could be loaded for the same file and one of them would lose updates"""
+    now = time.monotonic()
+    with dirty_sessions_lock:
+        dirty = set(dirty_sessions)
+    for user_id, session in sessions.items():
+        if session not in dirty and now - session.last_used >= SESSION_EVICT_IDLE:
+            break
+    else:
+        return # Everything is busy, the cache stays above the limit until sessions go idle
+    del sessions[user_id]
+    session.save_session()
+    logger.info(f"Evicted session for user {session.user_info} from memory")
+
+def flush_dirty_sessions():
+    """Save all sessions changed since the last flush"""
+    with dirty_sessions_lock:
+        pending = list(dirty_sessions)
+        dirty_sessions.clear()
+    for session in pending:
+        session.save_session()
+
+def load_file_id_cache():
+    """Load saved tg file_ids so files are not re-uploaded after restart"""
+    if not FILE_ID_CACHE_FILE.exists():
+        return
+    try:
+        with open(FILE_ID_CACHE_FILE, 'rb') as f:
+            file_id_cache.update(orjson.loads(f.read()))
+        logger.info(f"Loaded {len(file_id_cache)} cached file_ids")
+    except Exception as e:
+        logger.error(f"Failed to load file_id cache: {e}")
+
+def save_file_id_cache():
+    """Write file_id cache atomically via temp file + rename"""
+    file_id_cache_dirty.clear()
+    try:
+        FILE_ID_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = FILE_ID_CACHE_FILE.with_suffix('.tmp')
+        with open(tmp_file, 'wb') as f:
+            f.write(orjson.dumps(dict(file_id_cache), option=JSON_DUMP_OPTIONS))
+        os.replace(tmp_file, FILE_ID_CACHE_FILE)
+        logger.info(f"Saved {len(file_id_cache)} cached file_ids")
+    except Exception as e:
+        logger.error(f"Failed to save file_id cache: {e}")
+
+def get_file_cache_key(file_path):
+    """Cache key includes mtime in ns and size, so a replaced file gets uploaded again"""
+    stat = os.stat(file_path)
+    return f"{file_path}:{stat.st_mtime_ns}:{stat.st_size}"
+
+def store_file_id(file_path, cache_key, file_id):
+    """Cache file_id under the current key, keys of older versions of the same file are dropped"""
+    prefix = f"{file_path}:"
+    for key in list(file_id_cache):
+        if key != cache_key and key.startswith(prefix):
+            file_id_cache.pop(key, None)
+    file_id_cache[cache_key] = file_id
+    file_id_cache_dirty.set()
+
+load_file_id_cache()
+
+def session_flusher():
+    """Background thread: periodically save changed sessions and file_id cache"""
+    while True:
+        time.sleep(SESSION_FLUSH_INTERVAL)
+        try:
+            flush_dirty_sessions()
+            if file_id_cache_dirty.is_set():
+                save_file_id_cache()
+        except Exception as e:
+            logger.error(f"Failed to flush sessions: {e}")
+
+threading.Thread(target=session_flusher, name="session_flusher", daemon=True).start()
+
+def journal_append(event):
+    """Append one stats event to the journal with a single write"""
+    line = orjson.dumps(event) + b"\n"
+    try:
+        with journal_lock:
+            journal_fp.write(line)
+            journal_size = journal_fp.tell()
+    except Exception as e:
+        logger.error(f"Failed to write journal event {event}: {e}")
+        return
+    if journal_size > JOURNAL_MAX_SIZE:
+        compact_journal()
+
+def compact_journal():
+    """Save all dirty sessions, after that the journal is not needed and can be truncated"""
+    with journal_lock:
+        flush_dirty_sessions()
+        journal_fp.truncate(0)
+        journal_fp.seek(0)
+    logger.info("Journal compacted")
+    if file_id_cache_dirty.is_set():
+        save_file_id_cache()
+
+def replay_journal():
+    """Apply journal events left after an unclean shutdown to the session files"""
+    if not JOURNAL_FILE.exists() or JOURNAL_FILE.stat().st_size == 0:
+        return
+
+    events_by_user = {}
+    with open(JOURNAL_FILE, 'rb') as f:
+        for line in f:
+            try:
+                event = orjson.loads(line)
+            except JSONDecodeError:
+                logger.warning(f"Skipping broken journal line: {line!r}")
+                continue
+            events_by_user.setdefault(event['user_id'], []).append(event)
+    logger.info(f"Replaying journal for {len(events_by_user)} users")
+
+    for user_id, events in events_by_user.items():
+        session_file = SESSIONS_DIR / f"user_{user_id}.json"
+        try:
+            data = {}
+            if session_file.exists():
+                with open(session_file, 'rb') as f:
+                    data = orjson.loads(f.read())
+
+            applied = 0
+            for event in events:
+                if event.get('reset'):
+                    data = { key: data[key] for key in ('user_id', 'user_name') if key in data }
+                    continue
+
+                theme_stats = data.setdefault('theme_stats', {}).setdefault(
+                    event['theme'], { 'question_stats': {}, 'total': 0, 'correct': 0 })
+                if event['total'] <= theme_stats['total']:
+                    continue # Already saved before shutdown
+                q_stats = theme_stats['question_stats'].setdefault(str(event['question_id']), {'total': 0, 'correct': 0})
+                q_stats['total'] += 1
+                theme_stats['total'] += 1
+                if event['correct']:
+                    q_stats['correct'] += 1
+                    theme_stats['correct'] += 1
+                applied += 1
+
+            session_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = session_file.with_suffix('.tmp')
+            with open(tmp_file, 'wb') as f:
+                f.write(orjson.dumps(data, option=JSON_DUMP_OPTIONS))
+            os.replace(tmp_file, session_file)
+            logger.info(f"Replayed {applied} of {len(events)} journal events for user {user_id}")
+        except Exception as e:
+            logger.error(f"Failed to replay journal for user {user_id}: {e}")
+
+    with journal_lock:
+        journal_fp.truncate(0)
+        journal_fp.seek(0)
+
+JOURNAL_FILE.parent.mkdir(parents=True, exist_ok=True)
+journal_fp = open(JOURNAL_FILE, 'ab', buffering=0)
+journal_lock = threading.Lock()
+atexit.register(compact_journal)
+
 def signal_handler(_signum, _frame, bot):
     """Handle shutdown signals"""
     logger.info("Received shutdown signal")
+    logger.info("Flushing sessions...")
+    compact_journal()
     logger.info("Stopping bot...")
     bot.stop_polling()
     sys.exit(0)
@@ -490,18 +846,105 @@ def signal_handler(_signum, _frame, bot):
 signal.signal(signal.SIGINT, lambda signum, frame: signal_handler(signum, frame, bot))
 signal.signal(signal.SIGTERM, lambda signum, frame: signal_handler(signum, frame, bot))
 
-def get_question_from_themes(themes, search_key, search_value):
-    iterator = (q for theme in themes.values() 
-                for q in theme['questions'] 
-                if q[search_key] == search_value
-        )
-    return next(iterator, None)
+class RateLimiter:
+    """Token bucket, acquire() sleeps until a token is available"""
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1  # Reserve a token, going negative makes next callers wait longer
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+class ChatSendQueue:
+    """Runs send tasks on a thread pool, tasks of one chat run one by one in submit order"""
+    def __init__(self, workers: int, max_pending: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="send")
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.queues = {}  # chat_id -> deque of tasks, present while the chat is being drained
+
+    def submit(self, chat_id, fn, /, *args, **kwargs):
+        self.pending.acquire()  # Backpressure for handlers when Telegram is slow
+        task = (fn, args, kwargs)
+        with self.lock:
+            queue = self.queues.get(chat_id)
+            if queue is not None:
+                queue.append(task)
+                return
+            self.queues[chat_id] = deque([task])
+        self.executor.submit(self._drain, chat_id)
+
+    def _drain(self, chat_id):
+        while True:
+            with self.lock:
+                queue = self.queues[chat_id]
+                if not queue:
+                    del self.queues[chat_id]
+                    return
+                fn, args, kwargs = queue.popleft()
+            try:
+                fn(*args, **kwargs)  # Every API call inside goes through limited_send
+            except Exception as e:
+                logger.error(f"Failed to send to chat {chat_id}: {e}")
+            finally:
+                self.pending.release()
+
+send_rate_limiter = RateLimiter(SEND_RATE_LIMIT)
+send_queue = ChatSendQueue(SEND_WORKERS, MAX_PENDING_SENDS)
+
+def limited_send(fn, *args, **kwargs):
+    """Wait for the global rate limit, and for retry_after if Telegram still answers 429"""
+    send_rate_limiter.acquire()
+    return antiflood(fn, *args, **kwargs)
+
+def send_message_async(chat_id, text, **kwargs):
+    """Queue bot.send_message, handlers don't wait for Telegram"""
+    send_queue.submit(chat_id, limited_send, bot.send_message, chat_id, text, **kwargs)
+
+def send_file_async(chat_id, file_path, **kwargs):
+    """Queue send_file after previously queued messages of the chat"""
+    send_queue.submit(chat_id, send_file, bot, chat_id, file_path, **kwargs)
+
+def edit_message_text(chat_id, message_id, text, **kwargs):
+    """bot.edit_message_text that ignores "message is not modified" from repeated clicks"""
+    try:
+        limited_send(bot.edit_message_text, text=text, chat_id=chat_id, message_id=message_id, **kwargs)
+    except telebot.apihelper.ApiTelegramException as e:
+        if "message is not modified" not in e.description:
+            raise
+        logger.debug(f"Message {message_id} in chat {chat_id} is not modified, skipping")
+
+def edit_message_async(chat_id, message_id, text, **kwargs):
+    """Queue edit_message_text after previously queued messages of the chat"""
+    send_queue.submit(chat_id, edit_message_text, chat_id, message_id, text, **kwargs)
+
+def send_question_task(session, chat_id, question_id, text, file_path, options_message, keyboard):
+    """Send task: question text, file, then options with buttons.
+    If any part fails the question can't be answered, so it is cleared and typed messages are not blocked"""
+    try:
+        limited_send(bot.send_message, chat_id, text)
+        if file_path and not send_file(bot, chat_id, file_path):
+            session.clear_last_question(question_id)
+            return
+        limited_send(bot.send_message, chat_id, options_message, reply_markup=keyboard)
+    except Exception:
+        session.clear_last_question(question_id)
+        raise
 
 def generate_and_send_question(session, chat_id, user_info):
     """Helper function to generate and send a question to user"""
     try:
         # Check if theme is selected
-        current_theme = session.question_selector.current_theme
+        current_theme = session.get_theme()
         if not current_theme:
             logger.info(f"Theme not selected for user {user_info}, sending theme selection")
             # Create keyboard with theme buttons
@@ -513,36 +956,30 @@ def generate_and_send_question(session, chat_id, user_info):
                     callback_data=f"theme:{theme['tag']}"
                 )
                 keyboard.add(button)
-            bot.send_message(chat_id, "Тема не выбрана. Выберите своего бойца:", reply_markup=keyboard)
+            send_message_async(chat_id, "Тема не выбрана. Выберите своего бойца:", reply_markup=keyboard)
             return False
             
         question = session.smart_get_question()
         
         logger.info(f"Generated question {question['question_id']} for user {user_info}")
 
-        bot.send_message(chat_id, f"{question['text']}\n\n")
-
-        if question.get('file'):
-            file_path = os.path.join('questions', question['file'])
-            if not send_file(bot, chat_id, file_path):
-                return False
-        
-        # Send options with keyboard
+        # Options with keyboard
         options = question['options']
-        options_text = "\n".join([f"{get_number_emoji(i)} {option}" for i, option in enumerate(options, 1)])
+        question['rendered_options'] = render_options(options)  # Reused when marking the answer
+        options_text = "\n".join(question['rendered_options'])
         options_message = ( f"{options_text}\n\n" )
+        keyboard = get_answer_keyboard_json(question['question_id'], len(options))
 
-        keyboard = types.InlineKeyboardMarkup(row_width=len(options))
-        buttons = [
-            types.InlineKeyboardButton( text=get_number_emoji(idx),  callback_data=f"answer:{question['question_id']}:{idx}" )
-            for idx in range(1, len(options)+1)
-        ]
-        keyboard.add(*buttons)
+        # Set before sending, so a fast click on the buttons finds the question
+        session.set_last_question(question)
 
-        bot.send_message(chat_id, options_message, reply_markup=keyboard)
+        file_path = os.path.join('questions', question['file']) if question.get('file') else None
+        send_queue.submit(
+            chat_id, send_question_task, session, chat_id, question['question_id'],
+            f"{question['text']}\n\n", file_path, options_message, keyboard
+        )
 
-        logger.info(f"Sent question with buttons to user {user_info}")
-        session.set_last_question(question)
+        logger.info(f"Queued question with buttons to user {user_info}")
         return True
     except ValueError as e:
         if str(e) == "Theme not selected.":
@@ -555,20 +992,20 @@ def generate_and_send_question(session, chat_id, user_info):
                     callback_data=f"theme:{theme['tag']}"
                 )
                 keyboard.add(button)
-            bot.send_message(chat_id, "Тема не выбрана. Выберите своего бойца:", reply_markup=keyboard)
+            send_message_async(chat_id, "Тема не выбрана. Выберите своего бойца:", reply_markup=keyboard)
         else:
             error_message = f"Ошибка при генерации вопроса: {e}"
             logger.error(f"Error generating question for user {user_info}: {e}")
-            bot.send_message(chat_id, error_message)
+            send_message_async(chat_id, error_message)
         return False
     
 @bot.message_handler(commands=['start'])
 def handle_start(message):
     user = message.from_user
-    user_info = get_user_info(user)
+    session = get_session(user)
+    user_info = session.user_info
     logger.info(f"Received /start command from user {user_info}")
     try:
-        session = get_session(user)
         session.reset_session()
         
         # Create theme selection keyboard
@@ -581,88 +1018,110 @@ def handle_start(message):
             "Добро пожаловать!\n\n"
             "Выберите тему:"
         )
-        bot.send_message(message.chat.id, welcome_text, reply_markup=keyboard)
+        send_message_async(message.chat.id, welcome_text, reply_markup=keyboard)
         logger.info(f"Session reset and theme selection sent for user {user_info}")
         
     except Exception as e:
         logger.error(f"Failed to reset session for user {user_info}: {e}", exc_info=True)
-        bot.send_message(message.chat.id, f"Произошла ошибка: {e}")
+        send_message_async(message.chat.id, f"Произошла ошибка: {e}")
 
 @bot.message_handler(func=lambda message: True)
 def handle_all_messages(message):
     user = message.from_user
-    user_info = get_user_info(user)
+    session = get_session(user)
+    user_info = session.user_info
     logger.info(f"Received message from user {user_info}: {message.text}")
 
     try:
-        session = get_session(user)
         last_question = session.get_last_question()
         if last_question and 'correct_option' in last_question:
             logger.info(f"Awaiting answer via buttons from user {user_info}")
-            bot.send_message(message.chat.id, "Используйте кнопки для ответа на вопрос.")
+            send_message_async(message.chat.id, "Используйте кнопки для ответа на вопрос.")
         else:
             generate_and_send_question(session, message.chat.id, user_info)
     except Exception as e:
         logger.error(f"Unexpected error handling message from user {user_info}: {e}", exc_info=True)
-        bot.send_message(message.chat.id, f"Произошла непредвиденная шибка: {e}")
+        send_message_async(message.chat.id, f"Произошла непредвиденная шибка: {e}")
 
 
         
+session_summaries = {} # session file -> (mtime_ns, user_name, {theme: (total, correct)}), reused until the file changes
+
+def load_session_summary(session_file):
+    """User name and per-theme totals of a session file, parsed again only if the file was rewritten"""
+    mtime = os.stat(session_file).st_mtime_ns
+    cached = session_summaries.get(session_file)
+    if cached and cached[0] == mtime:
+        return cached[1], cached[2]
+
+    with open(session_file, 'rb') as f:
+        user_data = orjson.loads(f.read())
+    user_name = user_data.get('user_name', 'Незвестный')
+    totals = {
+        theme: (t_stats.get('total', 0), t_stats.get('correct', 0))
+        for theme, t_stats in user_data.get('theme_stats', {}).items()
+    }
+    session_summaries[session_file] = (mtime, user_name, totals)
+    return user_name, totals
+
 def get_global_stats(theme: str = None):
     """Get global statistics across all users for specific theme or all themes"""
-    user_stats = []
-    
+    # Cached sessions may hold answers the flusher hasn't written yet, their in-memory stats win over files
+    with sessions_lock:
+        cached_sessions = list(sessions.values())
+    summaries = {}
+    for session in cached_sessions:
+        with session.lock:
+            summaries[str(session.user_id)] = (session.user_name, {
+                t_tag: (t_stats.get('total', 0), t_stats.get('correct', 0))
+                for t_tag, t_stats in session.data.get('theme_stats', {}).items()
+            })
+
     # Scan all user session files
     for session_file in glob.glob(os.path.join(SESSIONS_DIR, "*.json")):
+        user_id = Path(session_file).stem.replace('user_', '')
+        if user_id in summaries:
+            continue
         try:
-            with open(session_file, 'r', encoding='utf-8') as f:
-                user_data = json.load(f)
-                
-            theme_stats = user_data.get('theme_stats', {})
-            user_name = user_data.get('user_name', 'Незвестный')
-            user_id = Path(session_file).stem.replace('user_', '')
-            
-            # If theme specified, get stats only for that theme
-            if theme:
-                stats = theme_stats.get(theme, {'total': 0, 'correct': 0})
-                if stats['total'] > 0:
-                    user_stats.append({ 'user_id': user_id, 'user_name': user_name, 'total': stats['total'], 'correct': stats['correct'] })
-            # Otherwise, sum up stats for all themes
-            else:
-                total = 0
-                correct = 0
-                for t_stats in theme_stats.values():
-                    total += t_stats.get('total', 0)
-                    correct += t_stats.get('correct', 0)
-                if total > 0:
-                    percentage = (correct / total) * 100 if total > 0 else 0
-                    user_stats.append({ 'user_id': user_id, 'user_name': user_name, 'total': total, 'correct': correct, 'percentage': percentage })
-                    
+            summaries[user_id] = load_session_summary(session_file)
         except Exception as e:
             logger.error(f"Failed to load stats from {session_file}: {e}")
-            continue
+
+    user_stats = []
+    for user_id, (user_name, totals) in summaries.items():
+        # If theme specified, get stats only for that theme
+        if theme:
+            total, correct = totals.get(theme, (0, 0))
+            if total > 0:
+                user_stats.append({ 'user_id': user_id, 'user_name': user_name, 'total': total, 'correct': correct })
+        # Otherwise, sum up stats for all themes
+        else:
+            total = sum(t_total for t_total, _ in totals.values())
+            correct = sum(t_correct for _, t_correct in totals.values())
+            if total > 0:
+                percentage = (correct / total) * 100
+                user_stats.append({ 'user_id': user_id, 'user_name': user_name, 'total': total, 'correct': correct, 'percentage': percentage })
     
     # Sort users by correct answers (desc) and then by total answers (desc)
     return sorted( user_stats, key=lambda x: (x['correct'], x['total']), reverse=True )
 
-@bot.callback_query_handler(func=lambda call: call.data == "global_stats")
 def handle_global_stats_callback(call):
     user = call.from_user
-    user_info = get_user_info(user)
+    session = get_session(user)
+    user_info = session.user_info
     logger.info(f"Received global stats callback from user {user_info}")
     
     try:
-        session = get_session(user)
         current_theme = session.get_theme()
         stats = get_global_stats(current_theme)
         
         if not stats:
-            bot.send_message(call.message.chat.id, "Нет статистики темы")
+            send_message_async(call.message.chat.id, "Нет статистики темы")
             bot.answer_callback_query(call.id)
             return
             
         theme_name = session.question_selector.themes[current_theme]['name']
-        response = f"🏆 Рейтинг по теме {theme_name}\n\n"
+        response_lines = [f"🏆 Рейтинг по теме {theme_name}\n\n"]
         
         # Add stats for each user
         for i, stat in enumerate(stats, 1):
@@ -672,31 +1131,26 @@ def handle_global_stats_callback(call):
             else:
                 user_mark = f"@{stat['user_name']}"
             percentage = (stat['correct']/stat['total']*100)
-            response += (
+            response_lines.append(
                 f"{i}. {position_mark}{user_mark}: {stat['correct']}/{stat['total']} "
                 f"({percentage:.1f}%)\n"
             )
+        response = "".join(response_lines)
         
-        # Create keyboard with return button
-        keyboard = types.InlineKeyboardMarkup()
-        next_button = types.InlineKeyboardButton(text="Вернуться к вопросам ➡️", callback_data="next")
-        keyboard.add(next_button)
-        
-        bot.send_message( call.message.chat.id, response, reply_markup=keyboard)
+        send_message_async(call.message.chat.id, response, reply_markup=GLOBAL_STATS_KEYBOARD)
         bot.answer_callback_query(call.id)
         
     except Exception as e:
         logger.error(f"Error showing global stats for user {user_info}: {e}")
         bot.answer_callback_query(call.id, "Ошибка при показе рейтинга")
 
-@bot.callback_query_handler(func=lambda call: call.data == "stats")
 def handle_stats_callback(call):
 
     user = call.from_user
-    user_info = get_user_info(user)
+    session = get_session(user)
+    user_info = session.user_info
     logger.info(f"Received stats callback from user {user_info}")
     try:
-        session = get_session(user)
         stats = session.get_statistics()
         current_theme = session.get_theme()
         
@@ -713,7 +1167,7 @@ def handle_stats_callback(call):
         if theme_stats:
             position_mark = get_position_emoji(user_position) if user_position else ""
             percentage_str = f"{theme_stats['percentage']:.1f}%"
-            response = (
+            header = (
                 f"📊 *Статистика по теме {theme_stats['theme_name']}*\n"
                 f"🏆 Место в рейтинге: {user_position} из {len(global_stats)} {position_mark}\n\n"
                 f"Всего ответов {theme_stats['total']}, из них правильных: {theme_stats['correct']} ({percentage_str})\n\n"
@@ -729,28 +1183,21 @@ def handle_stats_callback(call):
             max_length = 3000
             if len(response_text) > max_length:
                 response_text = response_text[:max_length] + "..."
-            response += response_text
+            response = "".join((header, response_text))
         else:
             response = "По теме нет статистики"
         
-        # Create keyboard with return and global stats buttons
-        keyboard = types.InlineKeyboardMarkup()
-        next_button = types.InlineKeyboardButton(text="Вопрос ➡️", callback_data="next")
-        global_stats_button = types.InlineKeyboardButton(text="Общий рейтинг 🏆", callback_data="global_stats")
-        keyboard.add(next_button, global_stats_button)
-        
-        bot.send_message(call.message.chat.id, response, reply_markup=keyboard, parse_mode="Markdown")
+        send_message_async(call.message.chat.id, response, reply_markup=STATS_KEYBOARD, parse_mode="Markdown")
         bot.answer_callback_query(call.id)
     except Exception as e:
         logger.error(f"Error showing statistics for user {user_info}: {e}")
         bot.answer_callback_query(call.id, "Ошибка при показе статистики")
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "change_theme")
 def handle_change_theme_callback(call):
-    logger.info(f"Received change theme callback from user {get_user_info(call.from_user)}")
     user = call.from_user
     session = get_session(user)
+    logger.info(f"Received change theme callback from user {session.user_info}")
     
     # Create keyboard with theme options
     keyboard = types.InlineKeyboardMarkup(row_width=1)
@@ -763,46 +1210,41 @@ def handle_change_theme_callback(call):
     ]
     keyboard.add(*theme_buttons)
     
-    bot.send_message( call.message.chat.id, "Выберите тему вопросов:", reply_markup=keyboard )
+    send_message_async(call.message.chat.id, "Выберите тему вопросов:", reply_markup=keyboard)
     bot.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda call: call.data == "next")
 def handle_next_callback(call):
-    logger.info(f"Received next callback from user {get_user_info(call.from_user)}")
     user = call.from_user
-    user_info = get_user_info(user)
     session = get_session(user)
+    user_info = session.user_info
+    logger.info(f"Received next callback from user {user_info}")
     if generate_and_send_question(session, call.message.chat.id, user_info):
         bot.answer_callback_query(call.id)
     return
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("theme:"))
 def handle_theme_callback(call):
-    logger.info(f"Received theme callback from user {get_user_info(call.from_user)}: {call.data}")
+    user = call.from_user
+    session = get_session(user)
+    user_info = session.user_info
+    logger.info(f"Received theme callback from user {user_info}: {call.data}")
     try:
-        user = call.from_user
-        user_info = get_user_info(user)
-        session = get_session(user)
         
-        theme_parts = call.data.split(":")
-        if len(theme_parts) != 2:
+        _, _, theme = call.data.partition(":")
+        if not theme:
             logger.error(f"Invalid theme callback data format: {call.data}")
             bot.answer_callback_query(call.id, "Неверный формат данны")
             return
-            
-        theme = theme_parts[1]
 
-        if session.question_selector.set_theme(theme):
-            session.set_theme(theme)  # Save theme to user profile
+        if session.question_selector.has_theme(theme):
             session.data.update({ 'user_id': user.id, 'user_name': user.username or user.first_name, 'last_update': time.time() })
-            session.save_session()
+            session.set_theme(theme)  # Save theme to user profile
             
-            theme_info = session.question_selector.get_current_theme()
-            response = f"Выбрана тема {theme_info['name'].lower()}"
+            theme_name = session.question_selector.themes[theme]['name']
+            response = f"Выбрана тема {theme_name.lower()}"
         else:
             response = f"Не найдена тема {theme}"
 
-        bot.send_message(call.message.chat.id, response)
+        send_message_async(call.message.chat.id, response)
         # Generate new question after theme change
         generate_and_send_question(session, call.message.chat.id, user_info)
         bot.answer_callback_query(call.id)
@@ -811,31 +1253,31 @@ def handle_theme_callback(call):
         bot.answer_callback_query(call.id, "Произошла ошибка при выборе темы")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("answer:"))
 def handle_answer_callback(call):
-    user = call.from_user
-    user_info = get_user_info(user)
-    logger.info(f"Received answer callback from user {user_info}: {call.data}")
-
+    # Parse question_id and selected_option first, stale clicks are rejected before any other work
+    # "answer:<question_id>:<option>", sliced by separator positions without building a list
+    data = call.data
     try:
-        session = get_session(user)
-        
-        # Parse question_id and selected_option
-        try:
-            _, question_id, selected_option = call.data.split(':')
-            question_id = int(question_id)
-            selected_option = int(selected_option)
-        except (ValueError, IndexError) as e:
-            logger.error(f"Invalid callback data format: {call.data}, error: {e}")
-            bot.answer_callback_query(call.id, f"Неверный формат данных: {e}")
-            return
+        first_sep = data.index(':')
+        last_sep = data.rindex(':')
+        question_id = int(data[first_sep + 1:last_sep])
+        selected_option = int(data[last_sep + 1:])
+    except ValueError as e:
+        logger.error(f"Invalid callback data format from user {call.from_user.id}: {call.data}, error: {e}")
+        bot.answer_callback_query(call.id, f"Неверный формат данных: {e}")
+        return
 
-        last_question = session.get_last_question()
-        if not last_question or last_question.get('question_id') != question_id:
-            logger.warning(f"No matching question found for callback from user {user_info}")
-            bot.answer_callback_query(call.id, "Вы уже ответили на этот вопрос")
-            return
+    session = get_session(call.from_user)
+    last_question = session.pop_last_question(question_id)
+    if last_question is None:
+        logger.warning(f"Stale answer callback from user {call.from_user.id}: {call.data}")
+        bot.answer_callback_query(call.id, "Вы уже ответили на этот вопрос")
+        return
 
+    user_info = session.user_info
+    logger.info(f"Received answer callback from user {user_info}: {call.data}")
+
+    try:
         # Determine if answer is correct and get answers text
         correct_option = last_question.get('correct_option')
         is_correct = selected_option == correct_option
@@ -845,148 +1287,186 @@ def handle_answer_callback(call):
 
         # Get question data for explanations
         themes = session.question_selector.themes
-        current_theme = session.question_selector.current_theme
+        current_theme = last_question['theme']
         
         # Get data for current question from current theme
-        question_data = next(
-            (q for q in themes[current_theme]['questions'] 
-            if q['id'] == question_id),
-            None
-        )
+        question_data = themes[current_theme]['questions_by_id'].get(question_id)
         
-        # Find explanation for selected answer ONLY in current theme
-        selected_answer_data = next(
-            (q for q in themes[current_theme]['questions'] 
-            if q['correct_answer'] == selected_answer and q['id'] != question_id),
-            None
-        )
+        # Find explanation for selected answer ONLY in current theme, needed only for wrong answers
+        selected_answer_data = None
+        if not is_correct:
+            selected_answer_data = themes[current_theme]['questions_by_answer'].get(selected_answer)
+            if selected_answer_data is question_data:
+                selected_answer_data = None
 
         # Mark selected button with ✅ or ❌ and show correct answer
         options = last_question.get('options', [])
-        keyboard = types.InlineKeyboardMarkup(row_width=len(options))
-        buttons = []
         
-        # Prepare new options text with marks
-        options_text = []
-        for idx in range(1, len(options)+1):
-            option = options[idx - 1]
-            if idx == selected_option:
-                mark = "✅" if is_correct else "❌"
-                button_text = mark
-                options_text.append(f"{mark} {option}")
-            elif idx == correct_option and not is_correct:
-                mark = "✅"
-                button_text = mark
-                options_text.append(f"{mark} {option}")
-            else:
-                button_text = get_number_emoji(idx)
-                options_text.append(f"{get_number_emoji(idx)} {option}")
-            
-            buttons.append(
-                types.InlineKeyboardButton(
-                    text=button_text, 
-                    callback_data=f"answer:{question_id}:{idx}"
-                )
-            )
-        keyboard.add(*buttons)
+        # Prepare new options text with marks, only marked lines differ from the rendered question
+        options_text = list(last_question.get('rendered_options') or render_options(options))
+        button_texts = list(NUMBER_EMOJIS[:len(options)])
+        mark = "✅" if is_correct else "❌"
+        options_text[selected_option - 1] = f"{mark} {options[selected_option - 1]}"
+        button_texts[selected_option - 1] = mark
+        if not is_correct:
+            options_text[correct_option - 1] = f"✅ {options[correct_option - 1]}"
+            button_texts[correct_option - 1] = "✅"
+
+        keyboard = get_marked_answer_keyboard_json(question_id, button_texts)
         
         # Update message text with new marks
-        new_text = (
-            f"Варианты ответов:\n"
-            f"{chr(10).join(options_text)}\n\n"
-        )
+        new_text = "Варианты ответов:\n" + "\n".join(options_text) + "\n\n"
         
-        try:
-            # Update both keyboard and text
-            bot.edit_message_text(
-                text=new_text,
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                reply_markup=keyboard
-            )
-        except Exception as e:
-            logger.error(f"Failed to update message for user {user_info}: {e}")
+        # Update both keyboard and text
+        edit_message_async(call.message.chat.id, call.message.message_id, new_text, reply_markup=keyboard)
 
-        # Create keyboard with multiple buttons
-        keyboard = types.InlineKeyboardMarkup(row_width=3)
-        next_button = types.InlineKeyboardButton(text="Дальше ➡️", callback_data="next")
-        stats_button = types.InlineKeyboardButton(text="📊", callback_data="stats")
-        theme_button = types.InlineKeyboardButton(text="Тема 🔄", callback_data="change_theme")
-        keyboard.add(next_button, stats_button, theme_button)
+        keyboard = POST_ANSWER_KEYBOARD
+        selected_answer_lower = selected_answer.lower()
 
         # Prepare and send responses based on correctness
         if is_correct:
-            response = f"✅ Правильно, *{selected_answer.lower()}*! ✅\n\n"
+            parts = [f"✅ Правильно, *{selected_answer_lower}*! ✅\n\n"]
             logger.info(f"User {user_info} answered correctly: {selected_answer}")
             
             if question_data and 'explanation' in question_data:
-                response += "\n".join(question_data['explanation']) + "\n\n"
+                parts.append("\n".join(question_data['explanation']) + "\n\n")
 
-            bot.send_message(call.message.chat.id, response, reply_markup=keyboard, parse_mode="Markdown")
-            response = ""
+            send_message_async(call.message.chat.id, "".join(parts), reply_markup=keyboard, parse_mode="Markdown")
         else:
             # Send initial wrong answer message
-            response = (
-                f"❌ *{selected_answer}* — неправильный ответ ❌\n\n" #Неправильный ответ
+            parts = [
+                f"❌ *{selected_answer}* — неправильный ответ ❌\n\n", #Неправильный ответ
                 f"Правильный — *{correct_answer.lower()}*.\n\n" #Правильный ответ
-            )
+            ]
             if question_data and 'explanation' in question_data:   #Обьяснение правильного ответа
-                response += f"{chr(10).join(question_data['explanation'])}\n\n"
+                parts.append("\n".join(question_data['explanation']) + "\n\n")
 
-            if selected_answer_data is None or 'files' not in selected_answer_data:
-                bot.send_message(call.message.chat.id, response, parse_mode="Markdown", reply_markup=keyboard)
-                response = ""
-            
+            wrong_answer_file_path = None
             if selected_answer_data and 'files' in selected_answer_data:
                 wrong_answer_file_path = os.path.join('questions', selected_answer_data['files'][0])
-                if "mp3" in wrong_answer_file_path or "ogg" in wrong_answer_file_path:
-                    response += f"\nА вот как звучит *{selected_answer.lower()}*:" #А вот как звучит неправильный ответ
-                    bot.send_message(call.message.chat.id, response, parse_mode="Markdown")
-                    response = ""
-                    send_file(bot, call.message.chat.id, wrong_answer_file_path) #Неправильный ответ аудио
-
-                if "jpg" in wrong_answer_file_path or "png" in wrong_answer_file_path:
+                wrong_answer_file_ext = os.path.splitext(wrong_answer_file_path)[1].lower()
+                if wrong_answer_file_ext in AUDIO_EXTS:
+                    parts.append(f"\nА вот как звучит *{selected_answer_lower}*:") #А вот как звучит неправильный ответ
+                elif wrong_answer_file_ext in IMAGE_EXTS:
                     wrong_question = selected_answer_data['text'].lower()
-                    wrong_answer = selected_answer.lower()
-                    response += f"\nА вот как выглядит *{wrong_answer}* ({wrong_question}):" #А вот как выглядит неправильный ответ
-                    bot.send_message(call.message.chat.id, response, parse_mode="Markdown")
-                    response = ""
-                    send_file(bot, call.message.chat.id, wrong_answer_file_path) #Неправильный ответ картинка
-                
+                    parts.append(f"\nА вот как выглядит *{selected_answer_lower}* ({wrong_question}):") #А вот как выглядит неправильный ответ
+                else:
+                    wrong_answer_file_path = None
+
+            explanation = None
             if selected_answer_data and 'explanation' in selected_answer_data:  #Обьяснение неправильного ответа, если есть
-                response = ""
-                response += f"\n{chr(10).join(selected_answer_data['explanation'])}" 
-                bot.send_message(call.message.chat.id, response, parse_mode="Markdown", reply_markup=keyboard)
+                explanation = "\n" + "\n".join(selected_answer_data['explanation'])
+
+            # Text goes as the caption of the wrong answer file, explanation is appended while it fits
+            text = "".join(parts)
+            limit = MAX_CAPTION_LENGTH if wrong_answer_file_path else MAX_MESSAGE_LENGTH
+            if explanation and len(text) + len(explanation) <= limit:
+                text, explanation = text + explanation, None
+            last_keyboard = None if explanation else keyboard
+
+            if not wrong_answer_file_path:
+                send_message_async(call.message.chat.id, text, parse_mode="Markdown", reply_markup=last_keyboard)
+            elif len(text) <= MAX_CAPTION_LENGTH:
+                send_file_async(call.message.chat.id, wrong_answer_file_path, caption=text, parse_mode="Markdown", reply_markup=last_keyboard)
+            else:
+                send_message_async(call.message.chat.id, text, parse_mode="Markdown")
+                send_file_async(call.message.chat.id, wrong_answer_file_path, reply_markup=last_keyboard)
+
+            if explanation:
+                send_message_async(call.message.chat.id, explanation, parse_mode="Markdown", reply_markup=keyboard)
 
         bot.answer_callback_query(call.id)
 
-        # Update statistics and clear last question
+        # Update statistics, last question was already taken by pop_last_question
         session.update_question_stats( question_id=question_id,  is_correct=is_correct, theme=last_question['theme'] )
-        session.clear_last_question()
 
     except Exception as e:
         logger.error(f"Error handling answer callback from user {user_info}: {e}", exc_info=True)
-        bot.send_message(call.message.chat.id, f"Произошла чудовищная ошибка: {e}")
+        send_message_async(call.message.chat.id, f"Произошла чудовищная ошибка: {e}")
         bot.answer_callback_query(call.id, "Произошла чудовищная ошибка!")
 
-class CodeChangeHandler(FileSystemEventHandler):
+# Callback routing: exact callback_data, then the part before the first ':'
+CALLBACK_HANDLERS = {
+    "global_stats": handle_global_stats_callback,
+    "stats": handle_stats_callback,
+    "change_theme": handle_change_theme_callback,
+    "next": handle_next_callback,
+}
+CALLBACK_PREFIX_HANDLERS = {
+    "theme": handle_theme_callback,
+    "answer": handle_answer_callback,
+}
+
+@bot.callback_query_handler(func=lambda call: True)
+def handle_callback(call):
+    """Single entry point for all callback queries"""
+    if not call.data:
+        # Game callbacks and the like carry no data, nothing to route
+        bot.answer_callback_query(call.id)
+        return
+    handler = CALLBACK_HANDLERS.get(call.data)
+    if handler is None:
+        prefix, separator, _ = call.data.partition(':')
+        handler = CALLBACK_PREFIX_HANDLERS.get(prefix) if separator else None
+    if handler is None:
+        logger.warning(f"Unknown callback data from user {get_user_info(call.from_user)}: {call.data}")
+        bot.answer_callback_query(call.id)
+        return
+    handler(call)
+
+class CodeChangeHandler:
     def __init__(self):
-        self.last_modified = time.time()
+        self.restart_timer = None
+        self.lock = threading.Lock()
         
+    def dispatch(self, event):
+        """Watchdog entry point, only created and modified files are interesting"""
+        if event.event_type in ('created', 'modified'):
+            self.on_modified(event)
+
     def on_modified(self, event):
-        # Check if the modified file is either the bot code or a question file
-        is_bot_code = event.src_path.endswith('bot.py')
-        is_question_file = event.src_path.endswith('.json') and 'questions' in event.src_path
-        
-        if is_bot_code or is_question_file:
-            current_time = time.time()
-            if current_time - self.last_modified > 1:  # Prevent multiple reloads
-                self.last_modified = current_time
-                logger.info(f"Change detected in {event.src_path}. Restarting bot...")
-                try:
-                    os.execv(sys.executable, [sys.executable] + sys.argv)
-                except Exception as e:
-                    logger.error(f"Failed to restart bot: {e}")
+        if event.is_directory:
+            return
+        # Sessions are written by the bot itself
+        if 'sessions' in event.src_path:
+            return
+
+        # Question files are reloaded in place, only bot code needs a restart
+        if event.src_path.endswith('.json') and 'questions' in event.src_path:
+            logger.info(f"Change detected in {event.src_path}. Reloading theme...")
+            QUESTION_SELECTOR.reload_theme_file(event.src_path)
+            return
+
+        if os.path.basename(event.src_path) == 'bot.py':
+            logger.info(f"Change detected in {event.src_path}. Restarting bot in {RESTART_DEBOUNCE}s...")
+            # One save can produce several events, restart once they stop coming
+            with self.lock:
+                if self.restart_timer:
+                    self.restart_timer.cancel()
+                self.restart_timer = threading.Timer(RESTART_DEBOUNCE, self.restart)
+                self.restart_timer.daemon = True
+                self.restart_timer.start()
+
+    def restart(self):
+        logger.info("Restarting bot...")
+        compact_journal()  # execv skips atexit handlers
+        # Sessions were written by this process, no need to validate them again
+        os.environ['SKIP_SESSION_VALIDATION'] = '1'
+        try:
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+        except Exception as e:
+            logger.error(f"Failed to restart bot: {e}")
+
+def validate_json_file(file_path: Path):
+    """Check that one file parses as JSON"""
+    logger.info(f"Validating {file_path}")
+    try:
+        with open(file_path, 'rb') as f:
+            orjson.loads(f.read())
+    except JSONDecodeError as e:
+        error_msg = f"Invalid JSON in {file_path}: {str(e)}"
+        logger.error(error_msg)
+        raise
 
 def validate_json_files(directory: Path, description: str = "JSON files"):
     """Validate all JSON files in specified directory"""
@@ -1001,38 +1481,56 @@ def validate_json_files(directory: Path, description: str = "JSON files"):
         logger.info(f"No JSON files found in {directory}")
         return
         
-    for file_path in json_files:
-        try:
-            logger.info(f"Validating {file_path}")
-            with open(file_path, 'r', encoding='utf-8') as f:
-                json.load(f)
-        except JSONDecodeError as e:
-            error_msg = f"Invalid JSON in {file_path}: {str(e)}"
-            logger.error(error_msg)
-            raise
+    # I/O bound, so threads help; map re-raises the first error
+    with ThreadPoolExecutor(max_workers=min(8, len(json_files))) as executor:
+        list(executor.map(validate_json_file, json_files))
             
     logger.info(f"All {description} are valid")
 
-def send_file(bot, chat_id, file_path):
+def send_media_cached(send_method, chat_id, file_path, cache_key, get_file_id, **kwargs):
+    """Send by cached file_id, upload the file if there is none or Telegram doesn't know it anymore"""
+    file_id = file_id_cache.get(cache_key)
+    if file_id:
+        try:
+            logger.info(f"Sending cached file: {file_path}")
+            return limited_send(send_method, chat_id, file_id, **kwargs)
+        except telebot.apihelper.ApiTelegramException as e:
+            if "file identifier" not in e.description.lower():
+                raise
+            logger.warning(f"Cached file_id for {file_path} is no longer valid, uploading again")
+            file_id_cache.pop(cache_key, None)
+            file_id_cache_dirty.set()
+
+    with upload_locks_lock:
+        upload_lock = upload_locks.setdefault(cache_key, threading.Lock())
+    with upload_lock:
+        # Another worker may have uploaded the same file while we waited
+        file_id = file_id_cache.get(cache_key)
+        if file_id:
+            logger.info(f"Sending file uploaded meanwhile: {file_path}")
+            return limited_send(send_method, chat_id, file_id, **kwargs)
+        def upload():
+            # Opened per attempt, a retry after 429 must not send an already consumed file object
+            with open(file_path, 'rb') as file:
+                return send_method(chat_id, file, **kwargs)
+        message = limited_send(upload)
+        store_file_id(file_path, cache_key, get_file_id(message))
+    logger.info(f"Uploaded file: {file_path}, stored in cache: {file_id_cache[cache_key]}")
+    return message
+
+def send_file(bot, chat_id, file_path, caption=None, parse_mode=None, reply_markup=None):
     """Helper function to send files with caching file_ids
+    Caption text is sent as a separate message if the file can't be sent
     Returns: True if successful, False otherwise"""
+    media_kwargs = {'caption': caption, 'parse_mode': parse_mode, 'reply_markup': reply_markup}
     try:
-        if not os.path.exists(file_path):
-            logger.error(f"File not found: {file_path}")
-            bot.send_message(chat_id, f"Не найден файл {file_path}")
-            return False
+        cache_key = get_file_cache_key(file_path)
 
         # Determine file type and send accordingly
-        if file_path.endswith(('.mp3', '.ogg', '.wav')):
+        ext = os.path.splitext(file_path)[1].lower()
+        if ext in AUDIO_EXTS:
             try:
-                if file_path in file_id_cache:
-                    logger.info(f"Sending cached audio file: {file_path}")
-                    message = bot.send_voice(chat_id, file_id_cache[file_path])
-                else:
-                    with open(file_path, 'rb') as file:
-                        message = bot.send_voice(chat_id, file)
-                        file_id_cache[file_path] = message.voice.file_id
-                        logger.info(f"Sending audio file: {file_path}, stored in cache: {file_id_cache[file_path]}")
+                send_media_cached(bot.send_voice, chat_id, file_path, cache_key, lambda m: m.voice.file_id, **media_kwargs)
                 logger.info(f"Sent audio file: {file_path}")
                 return True
             except telebot.apihelper.ApiTelegramException as e:
@@ -1046,22 +1544,14 @@ def send_file(bot, chat_id, file_path):
                         "4. Добавьте бота в список исключений или разрешите отправку всем пользователям\n"
                     )
                     logger.error(f"Voice messages forbidden for {chat_id}")
-                    keyboard = types.InlineKeyboardMarkup()
-                    next_button = types.InlineKeyboardButton(text="Я разрешил ✅", callback_data="next")
-                    keyboard.add(next_button)
-                    bot.send_message(chat_id, error_message, reply_markup=keyboard)
+                    if caption:
+                        limited_send(bot.send_message, chat_id, caption, parse_mode=parse_mode)
+                    limited_send(bot.send_message, chat_id, error_message, reply_markup=VOICE_FORBIDDEN_KEYBOARD)
                     return False
                 raise
 
-        elif file_path.endswith(('.jpg', '.png', '.jpeg', '.webp', '.gif', '.bmp')):
-            if file_path in file_id_cache:
-                logger.info(f"Sending cached image file: {file_path}")
-                message = bot.send_photo(chat_id, file_id_cache[file_path])
-            else:
-                with open(file_path, 'rb') as file:
-                    message = bot.send_photo(chat_id, file)
-                    file_id_cache[file_path] = message.photo[0].file_id
-                    logger.info(f"Sending image file: {file_path}, stored in cache: {file_id_cache[file_path]}")
+        elif ext in IMAGE_EXTS:
+            send_media_cached(bot.send_photo, chat_id, file_path, cache_key, lambda m: m.photo[0].file_id, **media_kwargs)
             logger.info(f"Sent image file: {file_path}")
             return True
 
@@ -1069,32 +1559,69 @@ def send_file(bot, chat_id, file_path):
             logger.error(f"Unsupported file type: {file_path}")
             return False
 
+    except FileNotFoundError:
+        # No separate exists() check: stat for the cache key or open() fails instead
+        logger.error(f"File not found: {file_path}")
+        limited_send(bot.send_message, chat_id, f"Не найден файл {file_path}")
+        if caption:
+            limited_send(bot.send_message, chat_id, caption, parse_mode=parse_mode, reply_markup=reply_markup)
+        return False
     except Exception as e:
         logger.error(f"Failed to send file {file_path}: {e}")
-        bot.send_message(chat_id, f"Не удалось отправить файл {file_path}: {e}")
+        limited_send(bot.send_message, chat_id, f"Не удалось отправить файл {file_path}: {e}")
+        if caption:
+            limited_send(bot.send_message, chat_id, caption, parse_mode=parse_mode, reply_markup=reply_markup)
         return False
 
-if __name__ == '__main__':
-    logger.info("\n\n\nStarting bot...")
-    
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Receives updates pushed by Telegram and hands them to telebot workers"""
+    def do_POST(self):
+        if not hmac.compare_digest(self.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), WEBHOOK_SECRET):
+            logger.warning(f"Webhook request with wrong secret token from {self.client_address[0]}")
+            self.send_response(403)
+            self.end_headers()
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        # Answer Telegram right away, handlers run on telebot worker threads
+        self.send_response(200)
+        self.end_headers()
+        try:
+            update = types.Update.de_json(body.decode('utf-8'))
+        except Exception as e:
+            logger.error(f"Failed to parse webhook update: {e}")
+            return
+        bot.process_new_updates([update])
+
+    def log_message(self, format, *args):
+        pass  # Every update is logged by its handler
+
+def run_webhook():
+    """Let Telegram push updates instead of polling getUpdates"""
+    logger.info(f"Setting webhook to {WEBHOOK_URL}, listening on port {WEBHOOK_PORT}")
+    bot.set_webhook(
+        url=WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=ALLOWED_UPDATES,
+        drop_pending_updates=True
+    )
+    server = ThreadingHTTPServer(('0.0.0.0', WEBHOOK_PORT), WebhookHandler)
     try:
-        validate_json_files(QUESTIONS_DIR, "question files")
-        validate_json_files(SESSIONS_DIR, "user session files")
-    except Exception as e:
-        logger.error(f"Failed to validate JSON files: {e}")
-        sys.exit(1)
-        
-    # Set up file watcher
-    event_handler = CodeChangeHandler()
-    observer = Observer()
-    observer.schedule(event_handler, path='.', recursive=False)
-    observer.schedule(event_handler, path='questions', recursive=False)
-    observer.start()
-    
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def run_polling():
+    """Long polling with retries on network errors"""
     while True:
         try:
             logger.info("Starting bot polling...")
-            bot.infinity_polling()
+            bot.remove_webhook()  # getUpdates doesn't work while a webhook is set
+            bot.infinity_polling(
+                timeout=POLLING_TIMEOUT,
+                long_polling_timeout=LONG_POLLING_TIMEOUT,
+                skip_pending=True,
+                allowed_updates=ALLOWED_UPDATES
+            )
         except (requests.exceptions.ConnectionError, 
                 requests.exceptions.ReadTimeout,
                 NewConnectionError) as e:
@@ -1106,7 +1633,41 @@ if __name__ == '__main__':
             # Log any other unexpected errors
             logger.error(f"Bot crashed with unexpected error: {e}", exc_info=True)
             break
-        finally:
+
+if __name__ == '__main__':
+    logger.info("\n\n\nStarting bot...")
+    
+    try:
+        validate_json_files(QUESTIONS_DIR, "question files")
+        if os.environ.pop('SKIP_SESSION_VALIDATION', None):
+            logger.info("Restarted after code change, skipping session files validation")
+        else:
+            validate_json_files(SESSIONS_DIR, "user session files")
+    except Exception as e:
+        logger.error(f"Failed to validate JSON files: {e}")
+        sys.exit(1)
+
+    replay_journal()
+        
+    # File watcher for hot reload is only needed during development
+    observer = None
+    if os.getenv('AUSCULT_DEV_RELOAD') == '1':
+        from watchdog.observers import Observer
+        event_handler = CodeChangeHandler()
+        observer = Observer()
+        observer.schedule(event_handler, path='.', recursive=False)
+        observer.schedule(event_handler, path='questions', recursive=False)
+        observer.start()
+        logger.info("File watcher started")
+    
+    try:
+        if WEBHOOK_URL:
+            run_webhook()
+        else:
+            run_polling()
+    finally:
+        # Observer lives across network retries, stop it only when the bot is going down
+        if observer:
             observer.stop()
             observer.join()
-            logger.info("Bot stopped") 
\ No newline at end of file
+        logger.info("Bot stopped")
@@ -14,11 +14,17 @@ find . -type f -name "*.mp3" | while read -r file; do
     # Generate output file name with .ogg extension in same directory
     output_file="${dir_path}/$(basename "${file%.mp3}.ogg")"
     
+    # Skip files converted on a previous run
+    if [ -f "$output_file" ] && [ "$output_file" -nt "$file" ]; then
+        echo "File '$output_file' is up to date, skipping"
+        continue
+    fi
+    
     # Create output directory if it doesn't exist
     mkdir -p "$dir_path"
     
     # Convert file to ogg format with specified parameters
-    ffmpeg -i "$file" -c:a libopus -b:a 32k -vbr on -compression_level 10 -frame_duration 60 -application voip "$output_file"
+    ffmpeg -nostdin -y -i "$file" -c:a libopus -b:a 32k -vbr on -compression_level 10 -frame_duration 60 -application voip "$output_file"
     
     # Success message
     echo "File '$file' was successfully converted to '$output_file'"
@@ -1,15 +1,31 @@
-import json
+import atexit
+import base64
+import binascii
+import heapq
 import logging
 import os
 import random
+import re
+import signal
+import sqlite3
 import string
+import struct
+import sys
+import threading
+import time
+from bisect import bisect
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import accumulate
 from pathlib import Path
 
+import orjson
+import requests
 import telebot
-from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 from telebot import types
-
-import random as random_lib
+from telebot.util import antiflood
 
 # Configure logging
 logging.basicConfig(
@@ -19,151 +35,433 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-load_dotenv()
+if 'BOT_TOKEN' not in os.environ:
+    # .env is only needed for local runs, containers pass variables directly
+    from dotenv import load_dotenv
+    load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
-bot = telebot.TeleBot(BOT_TOKEN)
+HANDLER_THREADS = 16  # Handlers block on Telegram round-trips, so keep enough workers for bursts
+HTTP_POOL_SIZE = 64  # Keep-alive connections to Telegram API
+bot = telebot.TeleBot(BOT_TOKEN, num_threads=HANDLER_THREADS)
+
+# Pooled keep-alive session shared by all handler and audio threads, one host pool for api.telegram.org
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=3))
+telebot.apihelper.session = http_session
+telebot.apihelper.CONNECT_TIMEOUT = 5
+telebot.apihelper.READ_TIMEOUT = 20
+
+stats_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='stats')  # Statistics writes, off the handler threads
+
+SEND_RATE_LIMIT = 28  # Messages per second, just under Telegram's global limit for bots
+
+class RateLimiter:
+    """Token bucket, acquire() sleeps until a token is available"""
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1  # Reserve a token, going negative makes next callers wait longer
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+send_rate_limiter = RateLimiter(SEND_RATE_LIMIT)
+
+def limited_send(fn, *args, **kwargs):
+    """Wait for the global rate limit, and for retry_after if Telegram still answers 429"""
+    send_rate_limiter.acquire()
+    return antiflood(fn, *args, **kwargs)
+
+SEND_WORKERS = 8
+send_pool = ThreadPoolExecutor(max_workers=SEND_WORKERS, thread_name_prefix='send')
+_chat_queues = {}  # chat_id -> deque of pending sends, present while a worker drains it
+_chat_queues_lock = threading.Lock()
+
+def send_async(chat_id, fn, /, *args, **kwargs):
+    """Run a blocking send on send_pool, sends to one chat keep their order.
+    fn waits for the rate limit itself, each API call it makes goes through limited_send"""
+    task = (fn, args, kwargs)
+    with _chat_queues_lock:
+        queue = _chat_queues.get(chat_id)
+        if queue is not None:
+            queue.append(task)
+            return
+        _chat_queues[chat_id] = deque([task])
+    send_pool.submit(_drain_chat_queue, chat_id)
+
+def _drain_chat_queue(chat_id):
+    while True:
+        with _chat_queues_lock:
+            queue = _chat_queues[chat_id]
+            if not queue:
+                del _chat_queues[chat_id]
+                return
+            fn, args, kwargs = queue.popleft()
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            logger.error(f"Failed to send to chat {chat_id}: {e}")
+
+def send_message_async(chat_id, text, **kwargs):
+    """Queue rate-limited bot.send_message after previously queued sends of the chat"""
+    send_async(chat_id, limited_send, bot.send_message, chat_id, text, **kwargs)
+
+STATS_FILE = Path('data/statistics.json')  # Statistics of old versions, imported into STATS_DB_FILE once
+STATS_DB_FILE = Path('data/stats.db')
+STATS_DB_MMAP_SIZE = 64 * 1024 * 1024  # Bytes of stats.db SQLite may memory-map
+SAVE_DELAY = 5.0  # Seconds to collect changes before writing them to disk
+
+_pending_saves = set()  # Save functions waiting for the write-behind timer
+_pending_saves_lock = threading.Lock()
+_save_timer = None
+
+def schedule_save(save_fn):
+    """Write-behind: run save_fn in SAVE_DELAY seconds, repeated requests are merged"""
+    global _save_timer
+    with _pending_saves_lock:
+        _pending_saves.add(save_fn)
+        if _save_timer is None:
+            _save_timer = threading.Timer(SAVE_DELAY, flush_pending_saves)
+            _save_timer.daemon = True
+            _save_timer.start()
+
+def flush_pending_saves():
+    """Run all scheduled saves now, called by the timer and on exit"""
+    global _save_timer
+    with _pending_saves_lock:
+        saves = list(_pending_saves)
+        _pending_saves.clear()
+        if _save_timer is not None:
+            _save_timer.cancel()
+            _save_timer = None
+    for save_fn in saves:
+        save_fn()
+
+def write_json_atomic(path, data):
+    """Write serialized bytes to temp file and rename, readers never see a half-written file"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
 
 AUDIO_DIR = Path('audio')  
 AUDIO_ORIG_DIR = Path('audio/orig')  # Directory with original mp3 files
+FILE_IDS_FILE = Path('data/file_ids.json')  # Telegram file_ids of uploaded audio
+# Telegram error descriptions meaning user doesn't accept voice messages
+VOICE_RESTRICTION_RE = re.compile(r'voice_messages_forbidden|video messages|restricted', re.IGNORECASE)
+
+USER_INFO_TTL = 3600  # Seconds to reuse formatted user names in logs
+USER_INFO_CACHE_SIZE = 10000  # Entries kept per user cache, the oldest are dropped first
+_user_info_cache = {}  # user id -> (expires at, formatted name)
+
+def cached_user_info(user_id):
+    """Formatted user name from cache or None if missing or expired"""
+    entry = _user_info_cache.get(int(user_id))
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+def _cache_store(cache, user_id, value):
+    """Store value for USER_INFO_TTL, dropping the oldest entries beyond USER_INFO_CACHE_SIZE"""
+    cache.pop(user_id, None)  # Re-insert at the end, so the dict stays ordered by expiry time
+    cache[user_id] = (time.monotonic() + USER_INFO_TTL, value)
+    while len(cache) > USER_INFO_CACHE_SIZE:
+        try:
+            cache.pop(next(iter(cache)), None)
+        except (StopIteration, RuntimeError):  # Changed by another thread, next store will trim it
+            break
+
+def store_user_info(user_id, info):
+    _cache_store(_user_info_cache, int(user_id), info)
+    return info
+
+_chat_cache = {}  # user id -> (expires at, Chat)
+
+def cached_get_chat(user_id):
+    """bot.get_chat with USER_INFO_TTL cache, statistics list every user on each render"""
+    entry = _chat_cache.get(int(user_id))
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
+    chat = bot.get_chat(user_id)
+    _cache_store(_chat_cache, int(user_id), chat)
+    return chat
+
+EMPTY_QUESTION_STATS = {'correct': 0, 'total': 0}  # Read-only default for questions without answers
+LEADERBOARD_SIZE = 20
+GLOBAL_STATS_HEADER = "*Рейтинг пользователей:*\n"
+# Place labels of the leaderboard, medals for the first three
+LEADERBOARD_PLACES = ("🥇 Золото: ", "🥈 Серебро: ", "🥉 Бронза: ") + tuple(
+    f"{place}-е место: " for place in range(4, LEADERBOARD_SIZE + 1)
+)
+
+_rng = threading.local()
+
+def rng():
+    """Per-thread Random, handlers don't share the module-level generator"""
+    r = getattr(_rng, 'r', None)
+    if r is None:
+        r = _rng.r = random.Random()
+    return r
 
 class QuestionManager:
     def __init__(self, bot):
         logger.info("Initializing QuestionManager")
         self.bot = bot
         self.questions = self._load_questions()
+        self.stats_lock = threading.RLock()  # Guards self.stats and stats_db writes against concurrent handlers
+        self.stats_db = self._open_stats_db()
         self.stats = self._load_statistics()
-        self.all_answers = [q['correct_answer'] for q in self.questions]
-        self.current_options = {}
-        self.current_user_id = None  # Store current user ID for global stats
+        # Running per-user sums over all questions, rankings read them instead of summing every question
+        self._user_totals = {}
+        for user_id, user_stats in self.stats.items():
+            totals = self._user_totals[user_id] = {'correct': 0, 'total': 0}
+            for q_stats in user_stats.values():
+                totals['correct'] += q_stats['correct']
+                totals['total'] += q_stats['total']
+        self._pending_stat_rows = []  # (user_id, question_id, is_correct) not yet written to stats_db
+        self._weights_cache = {}  # user_id -> cumulative question weights, dropped when user's stats change
+        self._missing_audio = frozenset()  # Audio paths without ogg file, skipped when picking audio
+        self._build_indices()
+        # Rendered statistics are reused until any answer or reset bumps the version
+        self._stats_version = 0
+        self._user_stats_cache = {}  # user_id -> (version, message)
+        self._global_stats_cache = None  # (version, viewer_id, message)
+    
+    def _build_indices(self):
+        """Build every lookup derived from self.questions, the only place they are assigned"""
+        # Per-field arrays indexed by question position, hot paths use them instead of scanning dicts
+        self._ids = tuple(q['id'] for q in self.questions)
+        self._str_ids = tuple(str(question_id) for question_id in self._ids)  # Keys of per-question stats
+        self._answers = tuple(q['correct_answer'] for q in self.questions)
+        self._explanations = tuple(q['explanation']['detailed_text'] for q in self.questions)
+        self._audios = tuple(tuple(p for p in q.get('audio_paths', ()) if p not in self._missing_audio) for q in self.questions)
+        self._idx_by_id = {question_id: i for i, question_id in enumerate(self._ids)}
+        # Question whose correct answer is the given one, first question wins as the old linear search did
+        self._idx_by_answer = {answer: i for i, answer in reversed(list(enumerate(self._answers)))}
+        # Wrong answer candidates per question: answers of other questions with the same tag
+        answers_by_tag = {}
+        for q in self.questions:
+            answers_by_tag.setdefault(q['tag'], []).append((q['id'], q['correct_answer']))
+        self._same_tag_answers = {
+            q['id']: [answer for question_id, answer in answers_by_tag[q['tag']] if question_id != q['id']]
+            for q in self.questions
+        }
+        # Every option a question can offer in fixed order, answer buttons carry indices into it.
+        # Sorted, so the correct answer's index doesn't stand out in callback data
+        self._option_lists = {
+            q['id']: tuple(sorted(self._same_tag_answers[q['id']] + [q['correct_answer']]))
+            for q in self.questions
+        }
+        self._option_indices = {
+            question_id: {option: i for i, option in enumerate(option_list)}
+            for question_id, option_list in self._option_lists.items()
+        }
+        self._answer_messages = {}  # (question_id, selected_answer) -> rendered answer message
     
     def _load_questions(self):
+        logger.info("Loading questions from questions.json")
         try:
-            logger.info("Loading questions from questions.json")
-            with open('questions.json', 'r', encoding='utf-8') as f:
-                questions = json.load(f)
-                logger.info(f"Loaded {len(questions)} questions")
-                return questions
+            # orjson parses the raw bytes directly, no intermediate decoded str
+            with open('questions.json', 'rb') as f:
+                questions = orjson.loads(f.read())
         except FileNotFoundError:
             logger.warning("questions.json not found. Using empty question list")
             return []
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             logger.warning("questions.json is not valid JSON. Using empty question list")
             return []
+        logger.info(f"Loaded {len(questions)} questions")
+        # Callback data carries int ids, statistics keys are their str form. A bad id fails startup loudly
+        for question in questions:
+            question['id'] = int(question['id'])
+        return questions
+    
+    def _open_stats_db(self):
+        """SQLite in WAL mode: one answer is one small upsert instead of rewriting all statistics"""
+        STATS_DB_FILE.parent.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(STATS_DB_FILE, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(f"PRAGMA mmap_size={STATS_DB_MMAP_SIZE}")  # Pages are read through the mapping, no read() copies
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS stats ("
+            "user_id TEXT NOT NULL, question_id TEXT NOT NULL, "
+            "correct INTEGER NOT NULL DEFAULT 0, total INTEGER NOT NULL DEFAULT 0, "
+            "PRIMARY KEY (user_id, question_id)) WITHOUT ROWID"  # Rows live in the primary key b-tree, no second index
+        )
+        return db
     
     def _load_statistics(self):
-        stats_file = Path('data/statistics.json')
+        """Load statistics from stats_db into memory, reads are served from there"""
+        stats = {}
+        rows = self.stats_db.execute("SELECT user_id, question_id, correct, total FROM stats")
+        for user_id, question_id, correct, total in rows:
+            stats.setdefault(user_id, {})[question_id] = {'correct': correct, 'total': total}
+        if stats:
+            logger.info(f"Loaded statistics of {len(stats)} users")
+            return stats
+        return self._import_json_statistics()
+    
+    def _import_json_statistics(self):
+        """Move statistics.json of previous versions into stats_db"""
         try:
-            if stats_file.exists():
-                logger.info("Loading existing statistics")
-                with open(stats_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
+            if not STATS_FILE.exists():
+                logger.info("Creating new statistics")
+                return {}
+            with open(STATS_FILE, 'rb') as f:
+                stats = orjson.loads(f.read())
+        except (FileNotFoundError, orjson.JSONDecodeError):
             logger.warning("Failed to load statistics.json. Creating new statistics")
+            return {}
         
-        logger.info("Creating new statistics file")
-        stats_file.parent.mkdir(parents=True, exist_ok=True)
-        return {}
+        rows = [
+            (user_id, question_id, q_stats['correct'], q_stats['total'])
+            for user_id, user_stats in stats.items()
+            for question_id, q_stats in user_stats.items()
+            if q_stats['total'] > 0
+        ]
+        with self.stats_lock:
+            self.stats_db.execute("BEGIN")
+            self.stats_db.executemany("INSERT OR REPLACE INTO stats VALUES (?, ?, ?, ?)", rows)
+            self.stats_db.execute("COMMIT")
+        # Renamed once committed: after every user resets, an empty stats_db must not import the old file again
+        imported_file = STATS_FILE.with_suffix('.json.imported')
+        os.replace(STATS_FILE, imported_file)
+        logger.info(f"Imported statistics of {len(stats)} users from {STATS_FILE}, moved it to {imported_file}")
+        return stats
     
     def _get_user_stats(self, user_id):
-        """Get or create statistics for specific user"""
+        """Get or create statistics for specific user
+        Only answered questions have entries, readers fall back to EMPTY_QUESTION_STATS"""
         user_id = str(user_id)
-        if user_id not in self.stats:
-            # Create new stats for user
-            self.stats[user_id] = {}
-        
-        # Check and add missing question stats
-        for question in self.questions:
-            q_id = str(question['id'])
-            if q_id not in self.stats[user_id]:
-                self.stats[user_id][q_id] = {'correct': 0, 'total': 0}
-        
-        self._save_statistics()  # Save updated statistics
-        return self.stats[user_id]
+        user_stats = self.stats.get(user_id)
+        if user_stats is None:
+            with self.stats_lock:
+                user_stats = self.stats.setdefault(user_id, {})
+        return user_stats
     
-    def _save_statistics(self):
-        try:
-            logger.info("Saving statistics to file")
-            stats_file = Path('data/statistics.json')
-            stats_file.parent.mkdir(parents=True, exist_ok=True)
-            with open(stats_file, 'w', encoding='utf-8') as f:
-                json.dump(
-                    self.stats,
-                    f,
-                    ensure_ascii=False,
-                    indent=4,
-                    sort_keys=True
-                )
-        except IOError:
-            logger.warning("Failed to save statistics.json")
+    def _peek_user_stats(self, user_id):
+        """User statistics for reading, unlike _get_user_stats doesn't add missing entries"""
+        return self.stats.get(str(user_id), {})
     
-    def get_random_question(self, user_id):
-        if not self.questions:
-            logger.warning("No questions available")
-            return None
-        
-        # Calculate weights based on user's error rate
+    def _cumulative_weights(self, user_id):
+        """Question weights based on user's error rate, cumulated for random.choices"""
         weights = []
         user_stats = self._get_user_stats(user_id)
         
-        for question in self.questions:
-            stats = user_stats[str(question['id'])]
+        for q_id in self._str_ids:
+            stats = user_stats.get(q_id, EMPTY_QUESTION_STATS)
             if stats['total'] == 0:
                 weights.append(1.0)
             else:
                 error_rate = 1 - (stats['correct'] / stats['total'])
                 weights.append(0.2 + 0.8 * error_rate)
+        return list(accumulate(weights))
+    
+    def get_random_question(self, user_id):
+        if not self.questions:
+            logger.warning("No questions available")
+            return None
         
-        selected_question = random.choices(self.questions, weights=weights)[0]
+        cum_weights = self._weights_cache.get(str(user_id))
+        if cum_weights is None:
+            # Computed and stored under the lock, so an answer in between can't leave stale weights cached
+            with self.stats_lock:
+                cum_weights = self._weights_cache[str(user_id)] = self._cumulative_weights(user_id)
+        r = rng()
+        # Same bisect random.choices does for k=1, without building a one-item list on every question
+        selected_question = self.questions[bisect(cum_weights, r.random() * cum_weights[-1], 0, len(cum_weights) - 1)]
         
         # Get all answers with the same tag
-        same_tag_answers = [
-            q['correct_answer'] 
-            for q in self.questions 
-            if q['tag'] == selected_question['tag'] and q['id'] != selected_question['id']
-        ]
+        same_tag_answers = self._same_tag_answers[selected_question['id']]
         
         # Generate random options from answers with the same tag
         correct_answer = selected_question['correct_answer']
         
         if same_tag_answers:
             num_wrong_answers = min(3, len(same_tag_answers))
-            random_options = random.sample(same_tag_answers, k=num_wrong_answers)
+            options = r.sample(same_tag_answers, k=num_wrong_answers)
         else:
             logger.warning(f"No other answers found with tag {selected_question['tag']}")
-            random_options = []
+            options = []
         
-        options = random_options + [correct_answer]
+        # Wrong answers are already in random order, a random slot for the correct one makes the whole list shuffled
+        options.insert(r.randrange(len(options) + 1), correct_answer)
         
-        question_data = selected_question.copy()
-        question_data['options'] = options
+        # Only what send_question reads, audio and explanations are looked up by id
+        question_data = {'id': selected_question['id'], 'text': selected_question['text'], 'options': options}
         
         logger.info(
             f"Selected question {question_data['id']} for user {user_id} with "
             f"tag {selected_question['tag']}, "
-            f"stats: {user_stats[str(question_data['id'])]}. "
+            f"stats: {self._peek_user_stats(user_id).get(str(question_data['id']), EMPTY_QUESTION_STATS)}. "
             f"Generated {len(options)} options: {options}"
         )
         return question_data
     
     def update_statistics(self, user_id, question_id, is_correct):
-        user_stats = self._get_user_stats(user_id)
-        stats = user_stats[str(question_id)]
-        old_stats = dict(stats)
-        stats['total'] += 1
-        if is_correct:
-            stats['correct'] += 1
+        with self.stats_lock:
+            # Looked up under the lock, a concurrent reset replaces the user's stats dict
+            stats = self._get_user_stats(user_id).setdefault(str(question_id), {'correct': 0, 'total': 0})
+            old_stats = dict(stats)
+            totals = self._user_totals.setdefault(str(user_id), {'correct': 0, 'total': 0})
+            stats['total'] += 1
+            totals['total'] += 1
+            if is_correct:
+                stats['correct'] += 1
+                totals['correct'] += 1
+            self._stats_version += 1
+            self._weights_cache.pop(str(user_id), None)
+            self._pending_stat_rows.append((str(user_id), str(question_id), int(is_correct)))
+        schedule_save(self._flush_statistics)
         
         user_info = self.get_user_info(user_id)
         logger.info(
             f"Updated stats for user {user_info}, question {question_id}: "
             f"from {old_stats} to {stats}"
         )
-        self._save_statistics()
+    
+    def _flush_statistics(self):
+        """Write answers collected since the last flush in one transaction"""
+        with self.stats_lock:
+            rows, self._pending_stat_rows = self._pending_stat_rows, []
+            if not rows:
+                return
+            try:
+                with self.stats_db:
+                    self.stats_db.execute("BEGIN")
+                    self.stats_db.executemany(
+                        "INSERT INTO stats VALUES (?, ?, ?, 1) ON CONFLICT (user_id, question_id) "
+                        "DO UPDATE SET correct = correct + excluded.correct, total = total + 1",
+                        rows
+                    )
+            except sqlite3.Error as e:
+                logger.error(f"Failed to save statistics of {len(rows)} answers: {e}")
     
     def get_answer_message(self, question_id, selected_answer):
+        """Message about user's answer, rendered once per (question, answer) pair
+        The returned dict is shared between calls and must not be modified"""
+        key = (question_id, selected_answer)
+        answer_message = self._answer_messages.get(key)
+        if answer_message is None:
+            answer_message = self._render_answer_message(question_id, selected_answer)
+            self._answer_messages[key] = answer_message
+        return answer_message
+    
+    def _render_answer_message(self, question_id, selected_answer):
         """Generate message about user's answer"""
-        question = next(q for q in self.questions if q['id'] == question_id)
-        correct_answer = question['correct_answer']
+        idx = self._idx_by_id[question_id]
+        correct_answer = self._answers[idx]
+        explanation = self._explanations[idx]
         
         # If selected_answer is None, question state was lost
         if selected_answer is None:
@@ -179,28 +477,25 @@ class QuestionManager:
         if is_correct:
             return {
                 'first_text': (f"✅ Правильно, *{selected_answer.lower()}*! ✅\n\n"
-                                f"{question['explanation']['detailed_text']}"),
+                                f"{explanation}"),
                 'second_text': None,
                 'audio_paths': [],
                 'show_next_button': True
             }
         else:
             # Find question that contains selected answer as correct one
-            wrong_question = next(
-                (q for q in self.questions if q['correct_answer'] == selected_answer),
-                None
-            )
+            wrong_idx = self._idx_by_answer.get(selected_answer)
             
             first_text = (f"❌ *{selected_answer}* — неправильный ответ ❌\n"
                         f"Правильный ответ — *{correct_answer.lower()}*.\n\n"
-                        f"{question['explanation']['detailed_text']}\n\n"
+                        f"{explanation}\n\n"
                         f"А вот как звучит *{selected_answer.lower()}*:")
             
             second_text = None
             wrong_audio_paths = []
-            if wrong_question:
-                second_text = wrong_question['explanation']['detailed_text']
-                wrong_audio_paths = wrong_question.get('audio_paths', [])
+            if wrong_idx is not None:
+                second_text = self._explanations[wrong_idx]
+                wrong_audio_paths = self._audios[wrong_idx]
             
             return {
                 'first_text': first_text,
@@ -209,104 +504,100 @@ class QuestionManager:
                 'show_next_button': False
             }
     
-    def store_question_options(self, question_id, options):
-        """Store the current options for a question"""
-        self.current_options[question_id] = options
+    def set_missing_audio(self, missing_paths):
+        """Audio paths without a file are never picked for sending, replaced on every audio rescan
+        so files added later are picked again"""
+        self._missing_audio = frozenset(missing_paths)
+        self._build_indices()  # Rendered answer messages hold audio paths too, they are dropped with the rest
     
-    def get_stored_option(self, question_id, option_index):
+    def get_option_index(self, question_id, option):
+        """Position of option in question's fixed option list, stable across restarts"""
+        return self._option_indices[question_id][option]
+    
+    def get_option(self, question_id, option_index):
         """Get the actual answer text by its index"""
         try:
-            return self.current_options[question_id][option_index]
+            return self._option_lists[question_id][option_index]
         except (KeyError, IndexError):
             logger.error(f"Failed to get option {option_index} for question {question_id}")
             return None
     
     def check_answer(self, question_id, selected_answer):
         """Check if the selected answer is correct"""
-        try:
-            question = next(q for q in self.questions if q['id'] == question_id)
-            return selected_answer == question['correct_answer']
-        except StopIteration:
+        idx = self._idx_by_id.get(question_id)
+        if idx is None:
             logger.error(f"Question with id {question_id} not found")
             return False
+        return selected_answer == self._answers[idx]
     
     def get_user_statistics(self, user_id):
+        """Statistics message for user, rendered again only after statistics change"""
+        version = self._stats_version
+        cached = self._user_stats_cache.get(user_id)
+        if cached and cached[0] == version:
+            return cached[1]
+        message = self._render_user_statistics(user_id)
+        self._user_stats_cache[user_id] = (version, message)
+        return message
+    
+    def _render_user_statistics(self, user_id):
         """Generate statistics message for user"""
-        user_stats = self._get_user_stats(user_id)
+        user_stats = self._peek_user_stats(user_id)
         
         total_questions = 0
         total_correct = 0
         details = []
         
         # Calculate totals and prepare details for each question
-        for question in self.questions:
-            q_stats = user_stats[str(question['id'])]
+        for answer, q_id in zip(self._answers, self._str_ids):
+            q_stats = user_stats.get(q_id, EMPTY_QUESTION_STATS)
             total_questions += q_stats['total']
             total_correct += q_stats['correct']
             
             if q_stats['total'] > 0:
                 percentage = (q_stats['correct'] / q_stats['total']) * 100
                 details.append(
-                    f"*{question['correct_answer']}*: "
+                    f"*{answer}*: "
                     f"{q_stats['correct']}/{q_stats['total']} ({percentage:.1f}%)"
                 )
         
         # Calculate overall percentage for current user
         user_percentage = (total_correct / total_questions * 100) if total_questions > 0 else 0
         
-        # Get all users statistics for ranking
-        all_users_stats = {}
-        for uid, stats in self.stats.items():
-            user_total = 0
-            user_correct = 0
-            for q_stats in stats.values():
-                user_total += q_stats['total']
-                user_correct += q_stats['correct']
-            
-            if user_total > 0:  # Include only users with answers
-                percentage = (user_correct / user_total * 100) if user_total > 0 else 0
-                try:
-                    user = self.bot.get_chat(uid)
-                    user_name = f"@{user.username}" if user.username else user.first_name
-                    all_users_stats[uid] = {
-                        'name': user_name,
-                        'percentage': percentage,
-                        'total': user_total,
-                        'correct': user_correct
-                    }
-                except Exception as e:
-                    logger.error(f"Failed to get user info for {uid}: {e}")
-                    continue
-        
-        # Sort users by number of correct answers, then by total answers
-        sorted_users = sorted(
-            all_users_stats.items(),
-            key=lambda x: (x[1]['correct'], x[1]['total']),
-            reverse=True
-        )
+        # Running totals of users with answers are all ranking needs, only the leader's name is looked up
+        all_users_stats = self._ranked_totals()
         
-        # Find current user's position and the leader
-        user_position = next(
-            (i + 1 for i, (uid, _) in enumerate(sorted_users) if uid == str(user_id)),
-            len(sorted_users)
-        )
+        # Users are ranked by number of correct answers, then by total answers, earlier users win ties.
+        # Only the leader and current user's position are needed, so no full sort
+        user_id = str(user_id)
+        user_position = len(all_users_stats)
+        own_key = all_users_stats.get(user_id)
+        if own_key is not None:
+            user_position = 1
+            before_user = True
+            for uid, key in all_users_stats.items():
+                if uid == user_id:
+                    before_user = False
+                    continue
+                if key > own_key or (before_user and key == own_key):
+                    user_position += 1
         
         leader_info = ""
-        if sorted_users:
-            leader_id, leader_data = sorted_users[0]
-            if leader_id == str(user_id):
+        if all_users_stats:
+            leader_id, (leader_correct, leader_total) = max(all_users_stats.items(), key=lambda x: x[1])
+            if leader_id == user_id:
                 leader_info = "\n🏆 Поздравляем! Вы лидер рейтинга!"
             else:
-                leader_info = (f"\n👑 Leader: {leader_data['name']} "
-                                f"({leader_data['correct']} correct answers, "
-                                f"{leader_data['percentage']:.1f}%)")
+                leader_info = (f"\n👑 Leader: {self._display_name(leader_id)} "
+                                f"({leader_correct} correct answers, "
+                                f"{leader_correct / leader_total * 100:.1f}%)")
         
         # Construct message
         message = [
             "*Ваша статистика:*\n",
             f"Всего ответов: {total_questions}",
             f"Правильных ответов: {total_correct} ({user_percentage:.1f}%)",
-            f"Ваше место в рейтинге: {user_position} из {len(sorted_users)}{leader_info}\n",
+            f"Ваше место в рейтинге: {user_position} из {len(all_users_stats)}{leader_info}\n",
             "*Статистика по вопросам:*"
         ]
         
@@ -320,77 +611,60 @@ class QuestionManager:
         user_info = self.get_user_info(user_id)
         logger.info(f"Resetting statistics for user {user_info}")
         
-        # Create new empty statistics for all questions
-        self.stats[user_id] = {
-            str(q['id']): {'correct': 0, 'total': 0} 
-            for q in self.questions
-        }
-        
-        # Save updated statistics
-        self._save_statistics()
+        # Empty statistics, entries are created on the next answers
+        with self.stats_lock:
+            self.stats[user_id] = {}
+            self._user_totals.pop(user_id, None)
+            self._weights_cache.pop(user_id, None)
+            self._stats_version += 1
+            
+            # Save updated statistics, answers not flushed yet are dropped with the rest
+            self._pending_stat_rows = [row for row in self._pending_stat_rows if row[0] != user_id]
+            try:
+                self.stats_db.execute("DELETE FROM stats WHERE user_id = ?", (user_id,))
+            except sqlite3.Error as e:
+                logger.error(f"Failed to reset statistics for user {user_info}: {e}")
         logger.info(f"Statistics reset completed for user {user_info}")
     
-    def get_global_statistics(self):
+    def get_global_statistics(self, viewer_id):
+        """Global statistics message marking viewer_id, rendered again only after statistics change"""
+        version = self._stats_version
+        cached = self._global_stats_cache
+        if cached and cached[0] == version and cached[1] == viewer_id:
+            return cached[2]
+        message = self._render_global_statistics(viewer_id)
+        self._global_stats_cache = (version, viewer_id, message)
+        return message
+    
+    def _ranked_totals(self):
+        """(correct, total) of every user with answers, users are ranked by this tuple"""
+        return {uid: (totals['correct'], totals['total']) for uid, totals in list(self._user_totals.items()) if totals['total'] > 0}
+    
+    def _display_name(self, user_id):
+        """@username or first name for rankings, user id if the chat can't be fetched"""
+        try:
+            user = cached_get_chat(user_id)
+        except Exception as e:
+            logger.error(f"Failed to get user info for {user_id}: {e}")
+            return user_id
+        return f"@{user.username}" if user.username else user.first_name
+    
+    def _render_global_statistics(self, viewer_id):
         """Generate global statistics message"""
-        user_stats = {}
-        
-        # Collect statistics for each user
-        for user_id, stats in self.stats.items():
-            total_questions = 0
-            total_correct = 0
-            
-            for q_stats in stats.values():
-                total_questions += q_stats['total']
-                total_correct += q_stats['correct']
-            
-            if total_questions > 0:  # Skip users without answers
-                percentage = (total_correct / total_questions) * 100
-                try:
-                    user = self.bot.get_chat(user_id)
-                    # Use username if available, otherwise first_name
-                    user_name = f"@{user.username}" if user.username else user.first_name
-                    user_stats[user_id] = {
-                        'name': user_name,
-                        'total': total_questions,
-                        'correct': total_correct,
-                        'percentage': percentage
-                    }
-                except Exception as e:
-                    logger.error(f"Failed to get user info for {user_id}: {e}")
-                    continue
-        
-        # Sort first by number of correct answers, then by total answers
-        sorted_stats = sorted(
-            user_stats.items(),
-            key=lambda x: (x[1]['correct'], x[1]['total']),
-            reverse=True
-        )
-        
-        # Limit list to top 20 users
-        sorted_stats = sorted_stats[:20]
+        # Top 20 users by number of correct answers, then by total answers, names are fetched only for them
+        sorted_stats = heapq.nlargest(LEADERBOARD_SIZE, self._ranked_totals().items(), key=lambda x: x[1])
         
         # Form message
-        message = ["*Рейтинг пользователей:*\n"]
+        message = [GLOBAL_STATS_HEADER]
+        viewer_id = str(viewer_id)
         
-        # Dictionary for medals (only first three places)
-        medals = {
-            1: "🥇 Золото",
-            2: "🥈 Серебро",
-            3: "🥉 Бронза"
-        }
-        
-        for index, (user_id, stats) in enumerate(sorted_stats, 1):
-            if index in medals:
-                place = f"{medals[index]}: "
-            else:
-                place = f"{index}-е место: "
-            
+        for place, (user_id, (correct, total)) in zip(LEADERBOARD_PLACES, sorted_stats):
             # Add "(this is you)" note for the current user
-            current_user = " _(this is you)_" if user_id == str(self.current_user_id) else ""
+            current_user = " _(this is you)_" if user_id == viewer_id else ""
             
             message.append(
-                f"{place}*{stats['name']}*{current_user}: всего отвеченных вопросов: {stats['total']}, "
-                f"правильно из них: {stats['correct']} ({stats['percentage']:.0f}%)"
+                f"{place}*{self._display_name(user_id)}*{current_user}: всего отвеченных вопросов: {total}, "
+                f"правильно из них: {correct} ({correct / total * 100:.0f}%)"
             )
         
         if not sorted_stats:
@@ -400,41 +674,217 @@ class QuestionManager:
     
     def get_user_info(self, user_id):
         """Helper function to get user info for logs"""
+        info = cached_user_info(user_id)
+        if info is not None:
+            return info
         try:
-            user = self.bot.get_chat(user_id)
+            user = cached_get_chat(user_id)
             # Skip bot's own messages
             if user.is_bot:
-                return f"BOT ({user_id})"
-            return f"@{user.username}" if user.username else f"{user.first_name} ({user_id})"
+                return store_user_info(user_id, f"BOT ({user_id})")
+            return store_user_info(
+                user_id, f"@{user.username}" if user.username else f"{user.first_name} ({user_id})"
+            )
         except Exception as e:
             logger.error(f"Failed to get user info for {user_id}: {e}")
             return str(user_id)
 
 question_manager = QuestionManager(bot)
 
+NUMBER_EMOJIS = ("1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣", "🔟")
+OPTION_PREFIXES = tuple(f"{emoji} " for emoji in NUMBER_EMOJIS)
+RESPONSE_OK = "Правильно! ✅"
+RESPONSE_BAD = "Неправильно! ❌"
+
+# Keyboards don't change between requests, build them once
+POST_ANSWER_MARKUP = types.InlineKeyboardMarkup(row_width=2)
+POST_ANSWER_MARKUP.add(
+    types.InlineKeyboardButton("🔄 Следующий вопрос", callback_data="next_question"),
+    types.InlineKeyboardButton("📊 Моя статистика", callback_data="show_stats")
+)
+STATS_MARKUP = types.InlineKeyboardMarkup(row_width=2)
+STATS_MARKUP.add(
+    types.InlineKeyboardButton("🔄 Следующий вопрос", callback_data="next_question"),
+    types.InlineKeyboardButton("🌍 Общая статистика", callback_data="show_global_stats"),
+    types.InlineKeyboardButton("🎯 Сбросить статистику", callback_data="reset_stats")
+)
+GLOBAL_STATS_MARKUP = types.InlineKeyboardMarkup(row_width=2)
+GLOBAL_STATS_MARKUP.add(
+    types.InlineKeyboardButton("🔄 К вопросам", callback_data="next_question"),
+    types.InlineKeyboardButton("📊 Моя статистика", callback_data="show_stats")
+)
+GLOBAL_STATS_COMMAND_MARKUP = types.InlineKeyboardMarkup(row_width=1)
+GLOBAL_STATS_COMMAND_MARKUP.add(
+    types.InlineKeyboardButton("🔄 К вопросам", callback_data="next_question")
+)
+RESET_DONE_MARKUP = types.InlineKeyboardMarkup(row_width=1)
+RESET_DONE_MARKUP.add(types.InlineKeyboardButton("🔄 Начать заново", callback_data="next_question"))
+# Kept as ready JSON, telebot sends str reply_markup as is instead of serializing it on every send
+POST_ANSWER_MARKUP, STATS_MARKUP, GLOBAL_STATS_MARKUP, GLOBAL_STATS_COMMAND_MARKUP, RESET_DONE_MARKUP = (
+    markup.to_json() for markup in (
+        POST_ANSWER_MARKUP, STATS_MARKUP, GLOBAL_STATS_MARKUP, GLOBAL_STATS_COMMAND_MARKUP, RESET_DONE_MARKUP
+    )
+)
+
+MAX_CAPTION_LENGTH = 1024  # Telegram limit for media captions
+ALLOWED_UPDATES = ["message", "callback_query"]  # Only update types the bot has handlers for
+LONG_POLLING_TIMEOUT = 50  # Seconds Telegram holds getUpdates open, updates still arrive as soon as they exist
+POLLING_TIMEOUT = 55  # getUpdates request timeout, must exceed LONG_POLLING_TIMEOUT
+SERVICE_CALLBACKS = frozenset({"next_question", "show_stats", "reset_stats", "show_global_stats"})
+
+# question id, index in the question's fixed option list -> 8 chars of base64.
+# Older buttons held an index into the shuffled options ('<IB', 5 bytes) and can't be resolved anymore
+ANSWER_CALLBACK_FORMAT = struct.Struct('<IH')
+
+@lru_cache(maxsize=None)  # Bounded by questions x options, the same buttons are sent over and over
+def encode_answer_callback(question_id, option_index):
+    return base64.urlsafe_b64encode(ANSWER_CALLBACK_FORMAT.pack(question_id, option_index)).decode('ascii')
+
+def decode_answer_callback(data):
+    """Returns (question_id, option_index), option_index is None for buttons of older versions.
+    Raises ValueError for malformed data"""
+    if ':' in data:  # Buttons sent before the compact format
+        sep = data.rindex(':')
+        return int(data[:sep]), None
+    try:
+        payload = base64.urlsafe_b64decode(data)
+        if len(payload) == ANSWER_CALLBACK_FORMAT.size:
+            return ANSWER_CALLBACK_FORMAT.unpack(payload)
+        return struct.unpack_from('<I', payload)[0], None
+    except (struct.error, binascii.Error) as e:
+        raise ValueError(e)
+
+def get_answer_markup(question_id, options):
+    """Answer buttons as ready JSON, all in one row, each one names its option itself"""
+    buttons = [
+        {'text': emoji, 'callback_data': encode_answer_callback(question_id, question_manager.get_option_index(question_id, option))}
+        for emoji, option in zip(NUMBER_EMOJIS, options)
+    ]
+    return orjson.dumps({'inline_keyboard': [buttons]}).decode()
+
+def _load_file_ids():
+    try:
+        if FILE_IDS_FILE.exists():
+            with open(FILE_IDS_FILE, 'rb') as f:
+                return orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        logger.warning("Failed to load file_ids.json. Audio will be uploaded again")
+    return {}
+
+def _save_file_ids():
+    try:
+        with FILE_ID_LOCK:
+            # orjson serializes in one C pass, pretty-printing stays cheap enough to keep the file readable
+            data = orjson.dumps(FILE_ID_CACHE, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+        write_json_atomic(FILE_IDS_FILE, data)
+    except IOError:
+        logger.warning("Failed to save file_ids.json")
+
+FILE_ID_CACHE = _load_file_ids()  # "audio path:mtime_ns:size" -> {"voice": file_id, "document": file_id}
+FILE_ID_LOCK = threading.Lock()
+UPLOAD_LOCKS = {}  # (audio path, kind) -> lock held while that file is uploaded
+
+def _send_audio_cached(chat_id, audio_path, kind, full_path, **kwargs):
+    """Send audio as voice or document, uploading it only once and reusing Telegram file_id"""
+    send = bot.send_voice if kind == 'voice' else bot.send_document
+    # mtime and size in the key: a file replaced on disk gets uploaded again instead of sending the old file_id
+    stat = os.stat(full_path)
+    cache_key = f"{audio_path}:{stat.st_mtime_ns}:{stat.st_size}"
+    file_id = FILE_ID_CACHE.get(cache_key, {}).get(kind)
+    if file_id:
+        try:
+            return limited_send(send, chat_id, file_id, **kwargs)
+        except telebot.apihelper.ApiTelegramException as e:
+            if "wrong file identifier" not in str(e).lower():
+                raise
+            logger.warning(f"Cached file_id for {audio_path} ({kind}) is no longer valid, uploading again")
+            with FILE_ID_LOCK:
+                FILE_ID_CACHE[cache_key].pop(kind, None)
+
+    with FILE_ID_LOCK:
+        upload_lock = UPLOAD_LOCKS.setdefault((audio_path, kind), threading.Lock())
+    with upload_lock:
+        # Concurrent first sends of the same file wait here and reuse the file_id of one upload
+        file_id = FILE_ID_CACHE.get(cache_key, {}).get(kind)
+        if file_id:
+            return limited_send(send, chat_id, file_id, **kwargs)
+        # Read on each upload: uploads happen once per file_id, and a file changed on disk is never sent stale
+        with open(full_path, 'rb') as f:
+            data = f.read()
+        if kind == 'voice':
+            # Name and type go with the buffer itself; documents get their name from visible_file_name
+            data = (os.path.basename(full_path), data, 'audio/ogg')
+        message = limited_send(send, chat_id, data, **kwargs)
+        uploaded = message.voice if kind == 'voice' else message.document
+        with FILE_ID_LOCK:
+            # Entries of older versions of this file will never be sent again
+            for key in [key for key in FILE_ID_CACHE if key != cache_key and key.startswith(f"{audio_path}:")]:
+                del FILE_ID_CACHE[key]
+            FILE_ID_CACHE.setdefault(cache_key, {})[kind] = uploaded.file_id
+    schedule_save(_save_file_ids)
+    return message
+
+def _scan_audio_dir(root):
+    """Relative paths of all files under root, one directory walk instead of a stat per file"""
+    seen = set()
+    for dirpath, _, filenames in os.walk(root):
+        rel_dir = os.path.relpath(dirpath, root).replace(os.sep, '/')
+        prefix = '' if rel_dir == '.' else rel_dir + '/'
+        seen.update(prefix + filename for filename in filenames)
+    return seen
+
+def _build_audio_paths(audio_path):
+    mp3_audio_path = audio_path.replace('.ogg', '.mp3')
+    return os.fspath(AUDIO_DIR / audio_path), mp3_audio_path, os.fspath(AUDIO_ORIG_DIR / mp3_audio_path)
+
+def refresh_audio_files(*_):
+    """Rescan audio directories"""
+    global OGG_FILES, MP3_FILES, AUDIO_PATHS
+    OGG_FILES = frozenset(_scan_audio_dir(AUDIO_DIR)) if AUDIO_DIR.exists() else frozenset()
+    MP3_FILES = frozenset(_scan_audio_dir(AUDIO_ORIG_DIR)) if AUDIO_ORIG_DIR.exists() else frozenset()
+    AUDIO_PATHS = {name: _build_audio_paths(name) for name in OGG_FILES}
+    logger.info(f"Found {len(OGG_FILES)} ogg and {len(MP3_FILES)} mp3 audio files")
+
+# Existing audio files relative to AUDIO_DIR / AUDIO_ORIG_DIR, checked instead of stat calls
+OGG_FILES = frozenset()
+MP3_FILES = frozenset()
+AUDIO_PATHS = {}  # ogg path -> (ogg full path, mp3 path, mp3 full path) as plain str
+refresh_audio_files()
+
 def check_audio_files():
-    """Check if all audio files exist"""
+    """Check if all audio files exist
+    Returns: set of audio paths without ogg file"""
     missing_files = []
+    missing_ogg = set()
     for question in question_manager.questions:
-        for audio_path in question.get('audio_paths', []):
-            ogg_path = AUDIO_DIR / audio_path
-            mp3_path = AUDIO_ORIG_DIR / audio_path.replace('.ogg', '.mp3')
+        for audio_path in question.get('audio_paths', ()):
+            mp3_audio_path = audio_path.replace('.ogg', '.mp3')
             
-            if not ogg_path.exists():
+            if audio_path not in OGG_FILES:
                 missing_files.append(f"OGG: {audio_path}")
-            if not mp3_path.exists():
-                missing_files.append(f"MP3: {audio_path.replace('.ogg', '.mp3')}")
+                missing_ogg.add(audio_path)
+            if mp3_audio_path not in MP3_FILES:
+                missing_files.append(f"MP3: {mp3_audio_path}")
     
     if missing_files:
         logger.warning(f"Missing audio files: {missing_files}")
-    return len(missing_files) == 0
+    return missing_ogg
+
+def reload_audio_files(*_):
+    """SIGHUP handler after audio files change: rescan them and pick audio only from existing files.
+    Changed files are uploaded again, their file_ids are keyed by mtime"""
+    refresh_audio_files()
+    question_manager.set_missing_audio(check_audio_files())
 
 def get_user_info(user):
     """Helper function to get user info for logs"""
+    info = cached_user_info(user.id)
+    if info is not None:
+        return info
     # Skip bot's own messages
     if user.is_bot:
-        return f"BOT ({user.id})"
-    return f"@{user.username}" if user.username else f"{user.first_name} ({user.id})"
+        return store_user_info(user.id, f"BOT ({user.id})")
+    return store_user_info(user.id, f"@{user.username}" if user.username else f"{user.first_name} ({user.id})")
 
 def generate_random_filename(original_filename):
     """Generate random filename while preserving extension"""
@@ -442,64 +892,70 @@ def generate_random_filename(original_filename):
     extension = Path(original_filename).suffix
     # Generate random string for filename (10 characters)
     letters = string.ascii_lowercase + string.digits
-    random_name = ''.join(random_lib.choice(letters) for _ in range(10))
+    random_name = ''.join(rng().choices(letters, k=10))
     return f"audio_{random_name}{extension}"
 
 # Function for sending audio with error handling
-def send_audio_with_fallback(chat_id, audio_path, user_info):
-    """Send audio with fallback to document if voice messages are restricted"""
+def send_audio_with_fallback(chat_id, audio_path, user_info, caption=None, parse_mode=None):
+    """Send audio with fallback to document if voice messages are restricted
+    caption goes with the audio, or as a separate message if the audio can't be sent"""
+    text_kwargs = {'caption': caption, 'parse_mode': parse_mode} if caption else {}
+    
+    def send_caption_as_text():
+        if caption:
+            limited_send(bot.send_message, chat_id, caption, parse_mode=parse_mode)
+    
     try:
         # Remove audio/ prefix if exists
-        audio_path = str(audio_path).replace('audio/', '')
-        ogg_full_path = AUDIO_DIR / audio_path
-        mp3_full_path = AUDIO_ORIG_DIR / audio_path.replace('.ogg', '.mp3')
+        audio_path = audio_path.replace('audio/', '')
+        paths = AUDIO_PATHS.get(audio_path)
+        ogg_full_path, mp3_audio_path, mp3_full_path = paths if paths else _build_audio_paths(audio_path)
         
-        if not ogg_full_path.exists():
-            logger.error(f"Audio file not found: {ogg_full_path}")
-            bot.send_message(chat_id, f"Аудио файл не найден")
-            return
-
-        with open(ogg_full_path, 'rb') as audio:
-            success = False
-            try:
-                bot.send_voice(chat_id, audio)
-                success = True
-            except telebot.apihelper.ApiTelegramException as e:
-                error_msg = str(e).lower()
-                if any(restriction in error_msg for restriction in 
-                        ["voice_messages_forbidden", "video messages", "restricted"]):
-                    logger.info(f"Voice messages restricted for user {user_info}, trying document")
+        # Missing files were dropped by check_audio_files at startup, a file removed later ends in FileNotFoundError
+        success = False
+        try:
+            _send_audio_cached(chat_id, audio_path, 'voice', ogg_full_path, **text_kwargs)
+            success = True
+        except telebot.apihelper.ApiTelegramException as e:
+            if VOICE_RESTRICTION_RE.search(e.description or ''):
+                logger.info(f"Voice messages restricted for user {user_info}, trying document")
+                
+                if mp3_audio_path not in MP3_FILES:
+                    logger.error(f"Original MP3 file not found: {mp3_full_path}")
+                    send_caption_as_text()
+                    limited_send(bot.send_message, chat_id, f"Аудио файл не найден")
+                    return
                     
-                    if not mp3_full_path.exists():
-                        logger.error(f"Original MP3 file not found: {mp3_full_path}")
-                        bot.send_message(chat_id, f"Аудио файл не найден")
-                        return
-                        
-                    try:
-                        with open(mp3_full_path, 'rb') as mp3_audio:
-                            random_filename = generate_random_filename(mp3_full_path.name)
-                            bot.send_document(
-                                chat_id, 
-                                mp3_audio,
-                                visible_file_name=random_filename
-                            )
-                            success = True
-                    except telebot.apihelper.ApiTelegramException as doc_e:
-                        logger.error(f"Failed to send document to user {user_info}: {doc_e}")
-                else:
-                    logger.error(f"Unexpected error for user {user_info}: {e}")
-                    raise
-
-            if not success:
-                bot.send_message(
-                    chat_id,
-                    "❌ К сожалению, не удалось отправить аудио. "
-                    "Пожалуйста, проверьте настройки конфиденциальности в Telegram."
-                )
+                try:
+                    random_filename = generate_random_filename(mp3_full_path)
+                    _send_audio_cached(
+                        chat_id,
+                        audio_path,
+                        'document',
+                        mp3_full_path,
+                        visible_file_name=random_filename,
+                        **text_kwargs
+                    )
+                    success = True
+                except telebot.apihelper.ApiTelegramException as doc_e:
+                    logger.error(f"Failed to send document to user {user_info}: {doc_e}")
+            else:
+                logger.error(f"Unexpected error for user {user_info}: {e}")
+                raise
+
+        if not success:
+            send_caption_as_text()
+            limited_send(
+                bot.send_message,
+                chat_id,
+                "❌ К сожалению, не удалось отправить аудио. "
+                "Пожалуйста, проверьте настройки конфиденциальности в Telegram."
+            )
 
     except FileNotFoundError as e:
         logger.error(f"File operation error: {e}")
-        bot.send_message(chat_id, f"Ошибка при работе с аудио файлом")
+        send_caption_as_text()
+        limited_send(bot.send_message, chat_id, f"Ошибка при работе с аудио файлом")
 
 @bot.message_handler(commands=['start'])
 def send_welcome(message):
@@ -517,53 +973,47 @@ def send_question(message):
         bot.reply_to(message, "Вопросы не найдены.")
         return
     
-    options = question_data['options']
-    random.shuffle(options)
-    
-    question_manager.store_question_options(question_data['id'], options)
+    options = question_data['options']  # Already in random order
     
     # Format text with answer options
-    options_text = "\n".join([f"{i+1}️⃣ {option}" for i, option in enumerate(options)])
+    options_text = "\n".join(prefix + option for prefix, option in zip(OPTION_PREFIXES, options))
     
-    # Create buttons with numbers and emojis
-    markup = types.InlineKeyboardMarkup(row_width=len(options))  # All buttons in one row
-    number_emojis = ["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣", "🔟"]
-    buttons = []
-    for i in range(len(options)):
-        callback_data = f"{question_data['id']}:{i}"
-        buttons.append(types.InlineKeyboardButton(number_emojis[i], callback_data=callback_data))
-    markup.add(*buttons) 
+    markup = get_answer_markup(question_data['id'], options)
     
     logger.info(f"Sending question {question_data['id']} to user {user_info}")
     
-    # Send audio files
-    audio_paths = question_data.get('audio_paths', [])
+    # Audio first, then question with buttons: queued per chat, so the order is kept
+    # while the handler thread is released right away
+    chat_id = message.chat.id
+    audio_paths = question_manager._audios[question_manager._idx_by_id[question_data['id']]]
     if not audio_paths:
         logger.warning(f"No audio files available for question {question_data['id']}")
-        bot.send_message(message.chat.id, "Аудио файлы не найдены!")
+        send_message_async(chat_id, "Аудио файлы не найдены!")
     else:
-        selected_audio = random.choice(audio_paths)
+        selected_audio = rng().choice(audio_paths)
         logger.info(f"Selected audio file: {selected_audio}")
-        send_audio_with_fallback(message.chat.id, selected_audio, user_info)
+        send_async(chat_id, send_audio_with_fallback, chat_id, selected_audio, user_info)
     
     # Send question and answer options
     message_text = f"❓ {question_data['text']}\n\n{options_text}"
-    bot.send_message(message.chat.id, message_text, reply_markup=markup)
+    send_message_async(chat_id, message_text, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: True)
-def handle_answer(call):
-    # First check if this is a service button (stats, next question, etc)
-    if call.data in ["next_question", "show_stats", "reset_stats", "show_global_stats"]:
-        handle_post_answer_buttons(call)
-        return
+def _log_stats_failure(future):
+    if future.exception() is not None:
+        logger.error(f"Failed to update statistics: {future.exception()}")
+
+def wait_for_stats_writes():
+    """stats_executor runs answers one by one in order, an empty task finishes after all earlier ones,
+    so a stats view right after an answer already includes it"""
+    stats_executor.submit(int).result()
 
-    # Then handle answer buttons
+# Service buttons go to handle_post_answer_buttons, everything else with data is an answer button
+@bot.callback_query_handler(func=lambda call: call.data and call.data not in SERVICE_CALLBACKS)
+def handle_answer(call):
     try:
-        question_id, option_index = call.data.split(':')
-        question_id = int(question_id)
-        option_index = int(option_index)
+        question_id, option_index = decode_answer_callback(call.data)
         
-        selected_answer = question_manager.get_stored_option(question_id, option_index)
+        selected_answer = None if option_index is None else question_manager.get_option(question_id, option_index)
         is_correct = question_manager.check_answer(question_id, selected_answer)
         
         user_info = get_user_info(call.from_user)
@@ -572,49 +1022,47 @@ def handle_answer(call):
             f"Answer: {selected_answer}. Correct: {is_correct}"
         )
         
+        # Statistics are not needed for the reply, write them in the background
+        if selected_answer is not None:
+            stats_future = stats_executor.submit(question_manager.update_statistics, call.from_user.id, question_id, is_correct)
+            stats_future.add_done_callback(_log_stats_failure)
+        
         # Get detailed answer message
         answer_data = question_manager.get_answer_message(question_id, selected_answer)
         
         # Show brief response in popup
-        response = "Правильно! ✅" if is_correct else "Неправильно! ❌"
+        response = RESPONSE_OK if is_correct else RESPONSE_BAD
         bot.answer_callback_query(call.id, response)
         
-        # Create markup with buttons in one row
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        markup.add(
-            types.InlineKeyboardButton("🔄 Следующий вопрос", callback_data="next_question"),
-            types.InlineKeyboardButton("📊 Моя статистика", callback_data="show_stats")
-        )
-        
-        # Send first message with answer and correct description
-        first_message = answer_data['first_text']
-        should_show_markup = is_correct or answer_data.get('show_next_button', False)
+        markup = POST_ANSWER_MARKUP
+        chat_id = call.message.chat.id
         
-        bot.send_message(
-            call.message.chat.id, 
-            first_message, 
-            parse_mode='Markdown',
-            reply_markup=markup if should_show_markup else None
-        )
+        # Correct answer (or lost state) is a single message with buttons
+        if is_correct or answer_data['show_next_button']:
+            send_message_async(chat_id, answer_data['first_text'], parse_mode='Markdown', reply_markup=markup)
+            return
         
-        # If there is audio for wrong answer, send it
+        # Sends are queued, the handler thread is free for the next update right away.
+        # With audio the first text goes as its caption, one API call instead of two
+        first_text = answer_data['first_text']
         if answer_data['audio_paths']:
-            selected_audio = random.choice(answer_data['audio_paths'])
-            audio_path = AUDIO_DIR / selected_audio
-            send_audio_with_fallback(call.message.chat.id, audio_path, user_info)
+            selected_audio = rng().choice(answer_data['audio_paths'])
+            if len(first_text) <= MAX_CAPTION_LENGTH:
+                send_async(chat_id, send_audio_with_fallback, chat_id, selected_audio, user_info, first_text, 'Markdown')
+            else:
+                send_message_async(chat_id, first_text, parse_mode='Markdown')
+                send_async(chat_id, send_audio_with_fallback, chat_id, selected_audio, user_info)
+        else:
+            send_message_async(chat_id, first_text, parse_mode='Markdown')
         
         # Send second message with wrong answer description and buttons
         if answer_data['second_text']:
-            bot.send_message(
-                call.message.chat.id,
+            send_message_async(
+                chat_id,
                 answer_data['second_text'],
                 parse_mode='Markdown',
                 reply_markup=markup  # Add buttons to last message for wrong answer
             )
-        
-        # Update user's statistics only if we have a valid answer
-        if selected_answer is not None:
-            question_manager.update_statistics(call.from_user.id, question_id, is_correct)
             
     except ValueError as e:
         logger.error(f"Invalid callback data format: {call.data}")
@@ -624,78 +1072,63 @@ def handle_answer(call):
 @bot.message_handler(commands=['stats'])
 def send_global_stats(message):
     """Send global statistics"""
-    stats_message = question_manager.get_global_statistics()
-    markup = types.InlineKeyboardMarkup(row_width=1)
-    markup.add(
-        types.InlineKeyboardButton("🔄 К вопросам", callback_data="next_question")
-    )
+    wait_for_stats_writes()
+    stats_message = question_manager.get_global_statistics(message.from_user.id)
     bot.send_message(
         message.chat.id,
         stats_message,
         parse_mode='Markdown',
-        reply_markup=markup
-    )
-
-# И добавим кнопку общей статиски в существующие меню
-def get_stats_markup():
-    """Create markup with statistics buttons"""
-    markup = types.InlineKeyboardMarkup(row_width=1)
-    markup.add(
-        types.InlineKeyboardButton("🔄 Следующий вопрос", callback_data="next_question"),
-        types.InlineKeyboardButton("📊 Моя статистика", callback_data="show_stats"),
-        types.InlineKeyboardButton("🌍 Общая статистика", callback_data="show_global_stats")
+        reply_markup=GLOBAL_STATS_COMMAND_MARKUP
     )
-    return markup
 
-@bot.callback_query_handler(func=lambda call: call.data in ["next_question", "show_stats", "reset_stats", "show_global_stats"])
+@bot.callback_query_handler(func=lambda call: call.data in SERVICE_CALLBACKS)
 def handle_post_answer_buttons(call):
+    """Service buttons: next question, stats, reset"""
     if call.data == "next_question":
         send_question(call.message)
     elif call.data == "show_stats":
+        wait_for_stats_writes()
         stats_message = question_manager.get_user_statistics(call.from_user.id)
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        markup.add(
-            types.InlineKeyboardButton("🔄 Следующий вопрос", callback_data="next_question"),
-            types.InlineKeyboardButton("🌍 Общая статистика", callback_data="show_global_stats"),
-            types.InlineKeyboardButton("🎯 Сбросить статистику", callback_data="reset_stats")
-        )
         bot.send_message(
             call.message.chat.id,
             stats_message,
             parse_mode='Markdown',
-            reply_markup=markup
+            reply_markup=STATS_MARKUP
         )
     elif call.data == "show_global_stats":
-        # Сохраняем ID текущего пользователя перед вызовом метода
-        question_manager.current_user_id = call.from_user.id
-        stats_message = question_manager.get_global_statistics()
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        markup.add(
-            types.InlineKeyboardButton("🔄 К вопросам", callback_data="next_question"),
-            types.InlineKeyboardButton("📊 Моя статистика", callback_data="show_stats")
-        )
+        wait_for_stats_writes()
+        stats_message = question_manager.get_global_statistics(call.from_user.id)
         bot.send_message(
             call.message.chat.id,
             stats_message,
             parse_mode='Markdown',
-            reply_markup=markup
+            reply_markup=GLOBAL_STATS_MARKUP
         )
     elif call.data == "reset_stats":
         question_manager.reset_user_statistics(call.from_user.id)
         bot.answer_callback_query(call.id, "Статистика сброшена!")
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        markup.add(types.InlineKeyboardButton("🔄 Начать заново", callback_data="next_question"))
         bot.send_message(
             call.message.chat.id,
             "✨ Cтатистика сброшена.",
-            reply_markup=markup
+            reply_markup=RESET_DONE_MARKUP
         )
     bot.answer_callback_query(call.id)
 
 if __name__ == '__main__':
     logger.info("Bot started")
+    # Write pending file_ids and statistics, then close stats db on exit (atexit runs handlers in reverse order).
+    # SIGTERM goes through sys.exit so atexit runs
+    atexit.register(question_manager.stats_db.close)
+    atexit.register(flush_pending_saves)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    signal.signal(signal.SIGHUP, reload_audio_files)
     if not AUDIO_DIR.exists():
         logger.error(f"Audio directory not found: {AUDIO_DIR}")
     else:
-        check_audio_files()
-    bot.infinity_polling() 
\ No newline at end of file
+        question_manager.set_missing_audio(check_audio_files())
+    bot.infinity_polling(
+        timeout=POLLING_TIMEOUT,
+        long_polling_timeout=LONG_POLLING_TIMEOUT,
+        skip_pending=True,
+        allowed_updates=ALLOWED_UPDATES
+    ) 
\ No newline at end of file